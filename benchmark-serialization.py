@@ -0,0 +1,31 @@
+# Compares the response encodings of main.py: serialization time, deserialization time and
+# payload size of a 768-dim embedding. Run it with `python benchmark-serialization.py`
+
+import math
+import random
+import time
+from response_encoding import RESPONSE_ENCODINGS, encode_embedding, decode_embedding
+
+dim = 768
+iterations = 2000
+
+# A normalized random embedding, like the ones main.py publishes
+random.seed(42)
+embedding = [random.gauss(0, 1) for _ in range(dim)]
+norm = math.sqrt(sum(value * value for value in embedding))
+embedding = [value / norm for value in embedding]
+
+print(f"{'encoding':<10}{'bytes':>10}{'encode µs':>12}{'decode µs':>12}{'max error':>12}")
+for encoding in RESPONSE_ENCODINGS:
+    startTime = time.perf_counter()
+    for _ in range(iterations):
+        body, _, headers = encode_embedding("517b83f4-f711-4a48-9c82-2fa5703f238e", embedding, encoding)
+    encodeInUs = (time.perf_counter() - startTime) / iterations * 1e6
+
+    startTime = time.perf_counter()
+    for _ in range(iterations):
+        decoded = decode_embedding(body, headers)
+    decodeInUs = (time.perf_counter() - startTime) / iterations * 1e6
+
+    maxError = max(abs(a - b) for a, b in zip(embedding, decoded))
+    print(f"{encoding:<10}{len(body):>10}{encodeInUs:>12.1f}{decodeInUs:>12.1f}{maxError:>12.2e}")
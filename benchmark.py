@@ -0,0 +1,379 @@
+# Benchmarks the service and writes p50/p95/p99 latencies, throughput and peak RSS as JSON:
+#   python benchmark.py embed                 generate_embeddings for query and code inputs
+#   python benchmark.py rabbitmq              message round trip through the Consumer of main.py
+#   python benchmark.py rabbitmq --broker     round trip through a broker and a running main.py
+#   python benchmark.py webapi                search QPS of a running sbert-milvus-webapi-example.py
+#   python benchmark.py index                 index build time of the vector store of the examples
+# `--output run.json` saves the report and `--compare baseline.json` exits with 1 when a case
+# got slower than the baseline by more than `--tolerance`. Progress is printed to stderr.
+
+from os import environ
+import argparse
+import json
+import platform
+import resource
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Method bodies of growing length, repeated to reach the input lengths of the embed suite
+CODE_SAMPLE = "public bool IsPrime(int number) { if (number <= 1) return false; for (int i = 2; i <= Math.Sqrt(number); i++) { if (number % i == 0) return false; } return true; } "
+QUERY_SAMPLE = "what function checks whether a number is prime and returns early for small values "
+SEARCH_QUERIES = [
+    "how do I optimize image loading times?",
+    "have I done any database migration?",
+    "which service handles the payments?",
+    "where is the retry policy configured?"
+]
+
+def percentile(sortedValues, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sortedValues:
+        return None
+    index = min(len(sortedValues) - 1, max(0, int(round(fraction * len(sortedValues))) - 1))
+    return sortedValues[index]
+
+def summarize(name, latenciesInMs, items, duration, unit, **extra):
+    latencies = sorted(latenciesInMs)
+    result = {
+        "name": name,
+        "samples": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "throughput": round(items / duration, 2),
+        "throughput_unit": unit
+    }
+    result.update(extra)
+    print(f"{name:<40} p50 {result['p50_ms']:>9} ms  p95 {result['p95_ms']:>9} ms  p99 {result['p99_ms']:>9} ms  {result['throughput']:>9} {unit}", file=sys.stderr)
+    return result
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def sample_text(sample, tokens):
+    # Roughly `tokens` CodeBERT tokens, a word is a bit more than one token on average
+    words = sample.split()
+    return " ".join(words[i % len(words)] for i in range(max(1, int(tokens * 0.75))))
+
+def bench_embed(args):
+    import main
+    main.load_model()
+
+    results = []
+    for requestType, sample in (("query", QUERY_SAMPLE), ("code", CODE_SAMPLE)):
+        for length in args.lengths:
+            for batchSize in args.batch_sizes:
+                # Every iteration embeds new contents, so that no cache serves them
+                batches = [[f"{i}-{j} {sample_text(sample, length)}" for j in range(batchSize)] for i in range(args.warmup + args.iterations)]
+                for batch in batches[:args.warmup]:
+                    main.generate_embeddings(batch, requestType)
+
+                latencies = []
+                startTime = time.perf_counter()
+                for batch in batches[args.warmup:]:
+                    callStartTime = time.perf_counter()
+                    main.generate_embeddings(batch, requestType)
+                    latencies.append((time.perf_counter() - callStartTime) * 1000)
+                duration = time.perf_counter() - startTime
+                results.append(summarize(f"embed/{requestType}/len={length}/batch={batchSize}", latencies, len(latencies) * batchSize, duration, "embeddings/s"))
+    return results
+
+class FakeMethod:
+    def __init__(self, delivery_tag, consumer_tag):
+        self.delivery_tag = delivery_tag
+        self.consumer_tag = consumer_tag
+        self.exchange = "embeddings_requests"
+        self.routing_key = consumer_tag
+
+class FakeProperties:
+    def __init__(self, headers=None):
+        self.headers = headers
+
+class FakeFrame:
+    def __init__(self, method):
+        self.method = method
+
+class FakeChannel:
+    # In-memory stand-in for a pika channel in confirm mode: the "broker" confirms every publish
+    # on the next iteration of the I/O loop, and on_settled is called when a request is acked
+    # or nacked by the consumer
+    def __init__(self, consumer, on_settled):
+        from pika.spec import Basic
+        self.ack_method = Basic.Ack
+        self.consumer = consumer
+        self.on_settled = on_settled
+        self.is_open = True
+        self.sequence = 0
+        self.nacked = 0
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.sequence += 1
+        frame = FakeFrame(self.ack_method(delivery_tag=self.sequence))
+        self.consumer.ioloop.add_callback_threadsafe(lambda: self.consumer.on_confirm(frame))
+
+    def basic_ack(self, delivery_tag):
+        self.on_settled(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.nacked += 1
+        self.on_settled(delivery_tag)
+
+def request_message(requestType, length, encoding):
+    sample = QUERY_SAMPLE if requestType == "query" else CODE_SAMPLE
+    requestId = str(uuid.uuid4())
+    body = json.dumps({"requestId": requestId, "type": requestType, "content": f"{requestId} {sample_text(sample, length)}", "encoding": encoding})
+    return requestId, body
+
+def bench_rabbitmq_fake(args):
+    # Runs the production Consumer on its own I/O loop, only the channel is in memory: batching
+    # per lane, inference on the inference thread, publishing and the ack on the confirm
+    import main
+    main.load_model()
+
+    results = []
+    for requestType, length in (("query", 32), ("code", 256)):
+        for batchSize in args.batch_sizes:
+            # Every iteration delivers one full batch and waits until all its requests are acked
+            main.BATCH_MAX_SIZE = batchSize
+            consumer = main.Consumer()
+            latencies = []
+            sentAt = {}
+            state = {"iteration": 0, "deliveryTag": 0}
+
+            def send():
+                if state["iteration"] == args.iterations:
+                    consumer.ioloop.stop()
+                    return
+                state["iteration"] += 1
+                for _ in range(batchSize):
+                    state["deliveryTag"] += 1
+                    _, body = request_message(requestType, length, args.encoding)
+                    sentAt[state["deliveryTag"]] = time.perf_counter()
+                    consumer.on_message(channel, FakeMethod(state["deliveryTag"], requestType), FakeProperties(), body.encode("utf-8"))
+
+            def on_settled(deliveryTag):
+                latencies.append((time.perf_counter() - sentAt.pop(deliveryTag)) * 1000)
+                if not sentAt:
+                    consumer.ioloop.add_callback_threadsafe(send)
+
+            channel = FakeChannel(consumer, on_settled)
+            consumer.channel = channel
+            consumer.consumer_tags = {lane: lane for lane in main.LANES}
+            startTime = time.perf_counter()
+            consumer.ioloop.add_callback_threadsafe(send)
+            consumer.ioloop.start()
+            duration = time.perf_counter() - startTime
+            consumer.executor.shutdown(wait=True)
+            consumer.ioloop.close()
+            results.append(summarize(f"rabbitmq-fake/{requestType}/batch={batchSize}", latencies, len(latencies), duration, "messages/s", nacked=channel.nacked))
+    return results
+
+def bench_rabbitmq_broker(args):
+    # Publishes requests to a real broker and waits for the responses of a running main.py
+    from main import connect_to_rabbitmq, RABBITMQ_REQUESTS_EXCHANGE, RABBITMQ_CODE_RESPONSES_QUEUE, RABBITMQ_QUERY_RESPONSES_QUEUE
+
+    channel = connect_to_rabbitmq()
+    results = []
+    for requestType, length, responseQueue in (("query", 32, RABBITMQ_QUERY_RESPONSES_QUEUE), ("code", 256, RABBITMQ_CODE_RESPONSES_QUEUE)):
+        channel.queue_purge(responseQueue)
+        sentAt = {}
+        latencies = []
+        startTime = time.perf_counter()
+        for _ in range(args.requests):
+            requestId, body = request_message(requestType, length, args.encoding)
+            sentAt[requestId] = time.perf_counter()
+            # Published to the lane of the request type, like an up-to-date producer
+            channel.basic_publish(exchange=RABBITMQ_REQUESTS_EXCHANGE, routing_key=requestType, body=body)
+
+        for method, properties, body in channel.consume(responseQueue, inactivity_timeout=args.timeout):
+            if method is None:
+                print(f"Timed out waiting for {len(sentAt)} {requestType} responses", file=sys.stderr)
+                break
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            requestId = (properties.headers or {}).get("requestId")
+            if requestId in sentAt:
+                latencies.append((time.perf_counter() - sentAt.pop(requestId)) * 1000)
+            if not sentAt:
+                break
+        channel.cancel()
+        duration = time.perf_counter() - startTime
+        if latencies:
+            results.append(summarize(f"rabbitmq-broker/{requestType}", latencies, len(latencies), duration, "messages/s", lost=len(sentAt)))
+    channel.connection.close()
+    return results
+
+def bench_rabbitmq(args):
+    return bench_rabbitmq_broker(args) if args.broker else bench_rabbitmq_fake(args)
+
+def bench_webapi(args):
+    import urllib.request
+
+    def search(index):
+        if args.batch > 1:
+            path = "/similarity_search/batch"
+            payload = {"queries": [f"{SEARCH_QUERIES[(index + i) % len(SEARCH_QUERIES)]} {index}" for i in range(args.batch)], "top_k": args.top_k}
+        else:
+            path = "/similarity_search/"
+            # A distinct query per request unless the result cache is measured on purpose
+            query = SEARCH_QUERIES[index % len(SEARCH_QUERIES)]
+            payload = {"query": query if args.repeat_queries else f"{query} {index}"}
+        request = urllib.request.Request(args.url.rstrip("/") + path, json.dumps(payload).encode("utf-8"), {"Content-Type": "application/json"})
+        callStartTime = time.perf_counter()
+        with urllib.request.urlopen(request, timeout=args.timeout) as response:
+            response.read()
+        return (time.perf_counter() - callStartTime) * 1000
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(search, range(args.warmup)))
+        startTime = time.perf_counter()
+        latencies = list(pool.map(search, range(args.warmup, args.warmup + args.requests)))
+        duration = time.perf_counter() - startTime
+
+    name = f"webapi/search/concurrency={args.concurrency}/batch={args.batch}"
+    return [summarize(name, latencies, len(latencies) * args.batch, duration, "queries/s")]
+
+def bench_index(args):
+    # Inserts random normalized embeddings like the examples do, then builds and loads their
+    # index (VECTOR_INDEX, VECTOR_TYPE); VECTOR_STORE=local measures the in-process store
+    # instead of Milvus
+    import numpy as np
+    from pymilvus import FieldSchema, CollectionSchema, DataType
+    from vector_store import VECTOR_INDEX, VECTOR_TYPE, index_params, open_store, vector_field
+
+    fields = [
+        FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
+        vector_field(args.dim),
+        FieldSchema(name="code_snippet", dtype=DataType.VARCHAR, max_length=65535)
+    ]
+    store, _ = open_store("benchmark_embeddings", CollectionSchema(fields, "Benchmark Embeddings"), metric="IP", id_field="id", text_field="code_snippet", drop=True)
+
+    generator = np.random.default_rng(42)
+    latencies = []
+    startTime = time.perf_counter()
+    for start in range(0, args.rows, args.insert_chunk):
+        count = min(args.insert_chunk, args.rows - start)
+        vectors = generator.standard_normal((count, args.dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        callStartTime = time.perf_counter()
+        store.add(vectors.tolist(), [f"snippet {start + i}" for i in range(count)])
+        latencies.append((time.perf_counter() - callStartTime) * 1000)
+    insertDuration = time.perf_counter() - startTime
+
+    phases = {}
+    for phase, work in (
+        ("flush", store.flush),
+        ("create_index", lambda: store.create_index(index_params("IP", args.nlist, args.dim))),
+        ("load", store.load)
+    ):
+        phaseStartTime = time.perf_counter()
+        work()
+        phases[f"{phase}_s"] = round(time.perf_counter() - phaseStartTime, 3)
+    buildDuration = time.perf_counter() - startTime
+
+    results = [summarize(f"index/insert/chunk={args.insert_chunk}", latencies, args.rows, insertDuration, "rows/s", rows=args.rows, build_s=round(buildDuration, 3), index=VECTOR_INDEX, vector_type=VECTOR_TYPE, **phases)]
+
+    queries = generator.standard_normal((args.queries, args.dim), dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    latencies = []
+    startTime = time.perf_counter()
+    for query in queries:
+        callStartTime = time.perf_counter()
+        store.search([query.tolist()], 10, nprobe=10)
+        latencies.append((time.perf_counter() - callStartTime) * 1000)
+    results.append(summarize("index/search/top_k=10", latencies, len(latencies), time.perf_counter() - startTime, "queries/s"))
+    return results
+
+def compare(report, baseline, tolerance):
+    # A case regresses when its p95 grew or its throughput dropped by more than tolerance
+    previous = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        before = previous.get(result["name"])
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{result['name']}: p95 {before['p95_ms']} ms -> {result['p95_ms']} ms")
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{result['name']}: throughput {before['throughput']} -> {result['throughput']} {result['throughput_unit']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedify benchmark suite")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON report of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown against --compare")
+    suites = parser.add_subparsers(dest="suite", required=True)
+
+    embed = suites.add_parser("embed", help="generate_embeddings for query and code inputs")
+    embed.add_argument("--lengths", type=lambda value: [int(length) for length in value.split(",")], default=[16, 128, 512, 2048], help="comma-separated input lengths in tokens")
+    embed.add_argument("--batch-sizes", type=lambda value: [int(size) for size in value.split(",")], default=[1, 8, 32], help="comma-separated batch sizes")
+    embed.add_argument("--iterations", type=int, default=20)
+    embed.add_argument("--warmup", type=int, default=2)
+
+    rabbitmq = suites.add_parser("rabbitmq", help="request to response latency of the worker")
+    rabbitmq.add_argument("--broker", action="store_true", help="go through the RabbitMQ broker and a running main.py instead of an in-memory channel")
+    rabbitmq.add_argument("--batch-sizes", type=lambda value: [int(size) for size in value.split(",")], default=[1, 8, 32], help="comma-separated batch sizes of the in-memory channel")
+    rabbitmq.add_argument("--iterations", type=int, default=20, help="batches per batch size with the in-memory channel")
+    rabbitmq.add_argument("--requests", type=int, default=200, help="requests per type with --broker")
+    rabbitmq.add_argument("--encoding", default="json", help="response encoding requested")
+    rabbitmq.add_argument("--timeout", type=float, default=30, help="seconds to wait for a response with --broker")
+
+    webapi = suites.add_parser("webapi", help="search QPS of a running web API")
+    webapi.add_argument("--url", default="http://localhost:8000")
+    webapi.add_argument("--requests", type=int, default=500)
+    webapi.add_argument("--warmup", type=int, default=20)
+    webapi.add_argument("--concurrency", type=int, default=8)
+    webapi.add_argument("--batch", type=int, default=1, help="queries per request, above 1 uses /similarity_search/batch")
+    webapi.add_argument("--top-k", type=int, default=10)
+    webapi.add_argument("--repeat-queries", action="store_true", help="repeat the same queries to measure the result cache")
+    webapi.add_argument("--timeout", type=float, default=30)
+
+    index = suites.add_parser("index", help="index build time of the vector store of the examples")
+    index.add_argument("--rows", type=int, default=100000)
+    index.add_argument("--dim", type=int, default=768)
+    index.add_argument("--insert-chunk", type=int, default=1024)
+    index.add_argument("--nlist", type=int, default=128)
+    index.add_argument("--queries", type=int, default=200)
+
+    args = parser.parse_args()
+
+    suite = {"embed": bench_embed, "rabbitmq": bench_rabbitmq, "webapi": bench_webapi, "index": bench_index}[args.suite]
+    startTime = time.time()
+    results = suite(args)
+    report = {
+        "suite": args.suite,
+        "started_at": round(startTime, 3),
+        "duration_s": round(time.time() - startTime, 3),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "tolerance")},
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "variables": {key: value for key, value in environ.items() if key.startswith(("INFERENCE_", "BATCH_", "PADDING_", "EMBEDDING_", "TORCH_", "VECTOR_", "PQ_M", "PROJECTION_", "LOCAL_INDEX", "MAX_"))}
+        },
+        "results": results,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"No regression against {args.compare}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# Streams the methods (or whole files) of a source tree into the code_embeddings_py Milvus collection:
+#   python bulk-index.py path/to/repository
+# Milvus Lite works as well, which needs no server:
+#   python bulk-index.py path/to/repository --milvus-uri ./milvus.db
+# and so does the local vector store of vector_store.py, with VECTOR_STORE=local
+#
+# Snippets are read lazily, then tokenized, embedded and inserted by separate pipeline stages
+# connected with bounded queues, so the stages overlap and memory stays bounded. A checkpoint
+# file records how many snippets were inserted, an interrupted run resumes from there.
+#
+# With PROJECTION_DIM set, the embeddings are reduced by the PCA projection of the collection
+# (see projection.py), fitted on the first PROJECTION_SAMPLE snippets when there is none yet;
+# a tree with fewer snippets needs a projection fitted beforehand.
+
+import argparse
+import json
+import os
+import queue
+import re
+import threading
+import time
+import numpy as np
+from pymilvus import FieldSchema, CollectionSchema, DataType
+from main import load_model, tokenize_contents, embed_tokenized
+from projection import PROJECTION_DIM, PROJECTION_SAMPLE, load_projection, require_projection
+from vector_store import index_params, open_store, vector_field
+
+COLLECTION_NAME = "code_embeddings_py"
+MAX_SNIPPET_BYTES = 65535
+
+# A method or constructor declaration: access modifiers, a parameter list and an opening brace
+METHOD_SIGNATURE = re.compile(r"^[ \t]*(?:public|private|protected|internal|static)\b[^;{}()=]*\([^;{}]*\)[^;{}=]*\{", re.MULTILINE)
+SKIPPED_DIRECTORIES = {"bin", "obj", "node_modules", "packages"}
+# Verbatim strings, also interpolated: no escapes, a quote is doubled
+VERBATIM_STRING = re.compile(r'\$?@\$?"')
+
+def matching_brace(source, start):
+    # Index of the brace closing the one at start, skipping strings, characters and comments
+    depth = 0
+    index = start
+    while index < len(source):
+        char = source[index]
+        verbatim = VERBATIM_STRING.match(source, index) if char in "$@" else None
+        if verbatim:
+            index = verbatim.end()
+            while index < len(source) and (source[index] != '"' or source.startswith('""', index)):
+                index += 2 if source.startswith('""', index) else 1
+        elif char in "\"'":
+            index += 1
+            while index < len(source) and source[index] != char:
+                index += 2 if source[index] == "\\" else 1
+        elif source.startswith("//", index):
+            index = source.find("\n", index)
+            if index == -1:
+                return None
+        elif source.startswith("/*", index):
+            index = source.find("*/", index + 2)
+            if index == -1:
+                return None
+            index += 1
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return index
+        index += 1
+    return None
+
+def extract_methods(source):
+    for match in METHOD_SIGNATURE.finditer(source):
+        end = matching_brace(source, match.end() - 1)
+        if end is not None:
+            yield source[match.start():end + 1].strip()
+
+def iter_snippets(root, extensions, unit):
+    # Walk the tree in a stable order, so that a checkpoint points to the same snippet next run
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories[:] = sorted(name for name in subdirectories if not name.startswith(".") and name not in SKIPPED_DIRECTORIES)
+        for name in sorted(files):
+            if not name.endswith(extensions):
+                continue
+            path = os.path.join(directory, name)
+            with open(path, encoding="utf-8", errors="replace") as file:
+                source = file.read()
+            snippets = extract_methods(source) if unit == "method" else [source]
+            for snippet in snippets:
+                # Keep the snippet within the VARCHAR limit of the code_snippet field
+                yield os.path.relpath(path, root), snippet.encode("utf-8")[:MAX_SNIPPET_BYTES].decode("utf-8", errors="ignore")
+
+def read_checkpoint(path, root):
+    if path and os.path.exists(path):
+        with open(path) as file:
+            checkpoint = json.load(file)
+        if checkpoint.get("root") == os.path.abspath(root):
+            return checkpoint
+        print(f"Ignoring the checkpoint {path}, it belongs to {checkpoint.get('root')}")
+    return {"root": os.path.abspath(root), "inserted": 0, "completed": False}
+
+def write_checkpoint(path, checkpoint):
+    if path:
+        # Replace the file atomically, an interrupted write must not lose the checkpoint
+        with open(path + ".tmp", "w") as file:
+            json.dump(checkpoint, file)
+        os.replace(path + ".tmp", path)
+
+def open_collection(restart, milvus_uri, projection=None):
+    # Same schema as gpt-web-example.py
+    fields = [
+        FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
+        vector_field(projection.dim if projection else 768),
+        FieldSchema(name="code_snippet", dtype=DataType.VARCHAR, max_length=MAX_SNIPPET_BYTES)
+    ]
+    schema = CollectionSchema(fields, "Code Embeddings Collection")
+    store, _ = open_store(COLLECTION_NAME, schema, metric="IP", id_field="id", text_field="code_snippet", drop=restart, milvus_uri=milvus_uri, projection=projection)
+    return store
+
+def run_stage(work, inbox, outbox, errors):
+    # Pass every item of inbox through work into outbox until the None end marker; after a
+    # failure the inbox is still drained so that the previous stage never blocks
+    while (item := inbox.get()) is not None:
+        if errors:
+            continue
+        try:
+            outbox.put(work(item))
+        except Exception as error:
+            errors.append(error)
+    outbox.put(None)
+
+def read_batches(snippets, skip, batch_size, outbox, errors):
+    batch = []
+    try:
+        for index, snippet in enumerate(snippets):
+            if errors:
+                break
+            if index < skip:
+                continue
+            batch.append(snippet)
+            if len(batch) == batch_size:
+                outbox.put(batch)
+                batch = []
+        if batch and not errors:
+            outbox.put(batch)
+    except Exception as error:
+        errors.append(error)
+    outbox.put(None)
+
+def tokenize_batch(batch):
+    return batch, tokenize_contents([snippet for _, snippet in batch], "code")
+
+def embed_batch(item):
+    # float32 rows take an eighth of the memory of lists of Python floats, which matters while
+    # the first PROJECTION_SAMPLE embeddings are held back to fit the projection on
+    batch, (windows, chunk_counts) = item
+    return batch, np.asarray(embed_tokenized(windows, chunk_counts, "code"), dtype=np.float32)
+
+def bulk_index(root, extensions, unit, batch_size, insert_chunk, queue_depth, checkpoint_path, restart, milvus_uri=None):
+    checkpoint = read_checkpoint(None if restart else checkpoint_path, root)
+    if checkpoint["completed"]:
+        print(f"{root} is already indexed, use --restart to index it again")
+        return
+
+    load_model()
+    projection = load_projection(COLLECTION_NAME)
+    if PROJECTION_DIM and projection is None and checkpoint["inserted"]:
+        raise ValueError(f"The collection was indexed without the projection of {COLLECTION_NAME}, use --restart to index it with one")
+    # The collection is opened once the projection is fitted, its dimension depends on it
+    store = None if PROJECTION_DIM and projection is None else open_collection(restart, milvus_uri, projection)
+    if checkpoint["inserted"]:
+        print(f"Resuming after {checkpoint['inserted']} snippets")
+
+    # Reader -> tokenizer -> model -> inserter, each stage in its own thread except the inserter
+    errors = []
+    tokenize_queue = queue.Queue(queue_depth)
+    embed_queue = queue.Queue(queue_depth)
+    insert_queue = queue.Queue(queue_depth)
+    stages = [
+        threading.Thread(target=read_batches, args=(iter_snippets(root, extensions, unit), checkpoint["inserted"], batch_size, tokenize_queue, errors), daemon=True),
+        threading.Thread(target=run_stage, args=(tokenize_batch, tokenize_queue, embed_queue, errors), daemon=True),
+        threading.Thread(target=run_stage, args=(embed_batch, embed_queue, insert_queue, errors), daemon=True)
+    ]
+    for stage in stages:
+        stage.start()
+
+    startTime = time.time()
+    insertedThisRun = 0
+    snippets = []
+    embeddings = []
+
+    def insert_pending():
+        nonlocal insertedThisRun, store, projection
+        vectors = np.concatenate(embeddings)
+        if store is None:
+            projection = require_projection(COLLECTION_NAME, vectors)
+            store = open_collection(restart, milvus_uri, projection)
+        store.add(vectors, [snippet for _, snippet in snippets])
+        checkpoint["inserted"] += len(snippets)
+        insertedThisRun += len(snippets)
+        write_checkpoint(checkpoint_path, checkpoint)
+        docsPerSecond = insertedThisRun / (time.time() - startTime)
+        print(f"Inserted {checkpoint['inserted']} snippets, last from {snippets[-1][0]}, {round(docsPerSecond, 1)} docs/sec")
+        snippets.clear()
+        embeddings.clear()
+
+    while (item := insert_queue.get()) is not None:
+        if errors:
+            continue
+        batch, batch_embeddings = item
+        snippets.extend(batch)
+        embeddings.append(batch_embeddings)
+        # Hold back the first insert until there are enough embeddings to fit the projection on
+        if len(snippets) >= (insert_chunk if store is not None else max(insert_chunk, PROJECTION_SAMPLE)):
+            try:
+                insert_pending()
+            except Exception as error:
+                errors.append(error)
+
+    if errors:
+        # The local vector store only persists on flush, keep what the checkpoint counts
+        if store is not None:
+            store.flush()
+        raise errors[0]
+    if snippets:
+        insert_pending()
+    if store is None:
+        print(f"No snippets found under {root}")
+        return
+
+    store.flush()
+    # Same index as gpt-web-example.py
+    store.create_index(index_params("IP", 128, projection.dim if projection else 768))
+
+    checkpoint["completed"] = True
+    write_checkpoint(checkpoint_path, checkpoint)
+    duration = time.time() - startTime
+    print(f"Indexed {insertedThisRun} snippets in {round(duration, 2)} s, {round(insertedThisRun / max(duration, 1e-9), 1)} docs/sec, {checkpoint['inserted']} in total")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the code of a source tree into the code_embeddings_py Milvus collection")
+    parser.add_argument("root", help="source tree to index")
+    parser.add_argument("--extensions", default=".cs", help="comma-separated file extensions to index")
+    parser.add_argument("--unit", choices=("method", "file"), default="method", help="index every method or every file")
+    parser.add_argument("--batch-size", type=int, default=64, help="snippets tokenized and embedded together")
+    parser.add_argument("--insert-chunk", type=int, default=1024, help="snippets inserted into Milvus together")
+    parser.add_argument("--queue-depth", type=int, default=4, help="batches buffered between two pipeline stages")
+    parser.add_argument("--checkpoint", default="bulk-index.checkpoint.json", help="checkpoint file, empty to disable")
+    parser.add_argument("--restart", action="store_true", help="drop the collection and index the tree from the start")
+    parser.add_argument("--milvus-uri", help="Milvus URI, a local file path uses Milvus Lite (default: MILVUS_URI)")
+    args = parser.parse_args()
+
+    extensions = tuple(extension.strip() for extension in args.extensions.split(","))
+    bulk_index(args.root, extensions, args.unit, args.batch_size, args.insert_chunk, args.queue_depth, args.checkpoint, args.restart, args.milvus_uri)
@@ -0,0 +1,25 @@
+import argparse
+import json
+import os
+from transformers import AutoModel, AutoTokenizer
+
+# Save a pinned snapshot of CodeBERT for main.py to load with MODEL_PATH, without the hub:
+#   python download-codebert.py --revision <commit hash> --output models/codebert-base
+parser = argparse.ArgumentParser(description="Save a local snapshot of the CodeBERT tokenizer and weights")
+parser.add_argument("--model", default="microsoft/codebert-base")
+parser.add_argument("--revision", help="tag or commit hash to pin (default: the latest one)")
+parser.add_argument("--output", default="models/codebert-base")
+args = parser.parse_args()
+
+# Load the model
+tokenizer = AutoTokenizer.from_pretrained(args.model, revision=args.revision)
+model = AutoModel.from_pretrained(args.model, revision=args.revision)
+
+# Save the model, as safetensors so that the workers memory-map the weights instead of unpickling them
+tokenizer.save_pretrained(args.output)
+model.save_pretrained(args.output, safe_serialization=True)
+
+# Record the commit the weights come from, part of the embedding cache fingerprint of main.py
+with open(os.path.join(args.output, "snapshot.json"), "w") as file:
+    json.dump({"model": args.model, "revision": args.revision, "commit": getattr(model.config, "_commit_hash", None)}, file)
+print(f"Saved {args.model} to {args.output}, start the workers with MODEL_PATH={args.output}")
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+
+# Content-addressed cache of embeddings, keyed by hash(settings fingerprint, request type,
+# normalized content). Embeddings are kept as packed float32 blobs in an in-process LRU
+# tier bounded by a byte budget, and optionally in an SQLite file that survives restarts.
+class EmbeddingCache:
+    def __init__(self, fingerprint, max_bytes, disk_path=None):
+        # The fingerprint covers the model and the pooling settings, so entries computed
+        # with other settings are never returned
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self._connection = None
+        self._connection_pid = None
+
+    def key(self, requestType, content):
+        # Line endings and trailing whitespace do not change what the snippet means
+        normalized = "\n".join(line.rstrip() for line in content.replace("\r\n", "\n").split("\n")).strip()
+        return hashlib.sha256(f"{self.fingerprint}\0{requestType}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                blob = self.entries.get(key)
+                if blob is not None:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    found[key] = unpack(blob)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing and self.disk_path:
+            for key, blob in self._disk_get(missing).items():
+                self._remember(key, blob)
+                found[key] = unpack(blob)
+                with self.lock:
+                    self.stats["disk_hits"] += 1
+
+        with self.lock:
+            self.stats["misses"] += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, embeddings):
+        blobs = {key: pack(embedding) for key, embedding in embeddings.items()}
+        for key, blob in blobs.items():
+            self._remember(key, blob)
+        if self.disk_path:
+            self._disk_put(blobs)
+
+    def get_or_compute(self, requestType, contents, compute):
+        # Embeddings of contents in order, compute(contents) runs only on the contents that are
+        # not cached, each distinct content once
+        keys = [self.key(requestType, content) for content in contents]
+        embeddings = self.get_many(keys)
+
+        missing = {}
+        for key, content in zip(keys, contents):
+            if key not in embeddings:
+                missing.setdefault(key, content)
+        if missing:
+            computed = dict(zip(missing, compute(list(missing.values()))))
+            self.put_many(computed)
+            embeddings.update(computed)
+
+        return [embeddings[key] for key in keys]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            if self.disk_path:
+                connection = self._disk()
+                connection.execute("DELETE FROM embeddings")
+                connection.commit()
+
+    def counters(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.size)
+
+    def _remember(self, key, blob):
+        if len(blob) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = blob
+            self.size += len(blob)
+            # Evict the least recently used embeddings until the tier fits its byte budget
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats["evictions"] += 1
+
+    def _disk(self):
+        # SQLite connections can not be shared with forked processes, open one per process
+        if self._connection is None or self._connection_pid != os.getpid():
+            connection = sqlite3.connect(self.disk_path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+            # Drop the embeddings computed with another model or other pooling settings
+            row = connection.execute("SELECT value FROM settings WHERE name = 'fingerprint'").fetchone()
+            if row is None or row[0] != self.fingerprint:
+                connection.execute("DELETE FROM embeddings")
+                connection.execute("INSERT OR REPLACE INTO settings VALUES ('fingerprint', ?)", (self.fingerprint,))
+                connection.commit()
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def _disk_get(self, keys):
+        with self.lock:
+            connection = self._disk()
+            found = {}
+            # Stay below the SQLite limit of variables per statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = connection.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk)
+                found.update(rows.fetchall())
+            return found
+
+    def _disk_put(self, blobs):
+        with self.lock:
+            connection = self._disk()
+            connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", blobs.items())
+            connection.commit()
+
+def pack(embedding):
+    return array("f", embedding).tobytes()
+
+def unpack(blob):
+    embedding = array("f")
+    embedding.frombytes(blob)
+    return embedding.tolist()
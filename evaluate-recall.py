@@ -0,0 +1,159 @@
+# Measures how much search quality a smaller collection costs before switching to it: the
+# recall@k of every combination of projection dimension (see projection.py), vector type and
+# index against exact float32 search over the full-dimensional embeddings, e.g.
+#   python evaluate-recall.py vector-store/code_embeddings_py/vectors.npy --dims 768,256,128 --types float32,float16
+# Queries are rows held out of the embeddings file, or the rows of --queries. Every combination
+# is searched with the local vector store, and with --milvus-uri (or MILVUS_URI) also with the
+# Milvus --indexes in a temporary collection. The report is JSON like the one of benchmark.py,
+# with the recall, the search latencies and the bytes stored per vector; --min-recall exits
+# with 1 when a combination falls below it.
+
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from benchmark import peak_rss_mb, summarize
+from projection import fit
+from vector_store import MILVUS_URI, LocalStore, MilvusStore, connect_milvus, index_params, vector_field
+
+EVALUATION_COLLECTION = "recall_evaluation"
+
+def split_queries(embeddings, count, seed=0):
+    # Hold count random rows out of the corpus as queries
+    held_out = np.zeros(len(embeddings), dtype=bool)
+    held_out[np.random.default_rng(seed).choice(len(embeddings), count, replace=False)] = True
+    return embeddings[~held_out], embeddings[held_out]
+
+def search_all(store, queries, top_k, nprobe):
+    latencies = []
+    ids = []
+    startTime = time.perf_counter()
+    for query in queries:
+        callStartTime = time.perf_counter()
+        hits = store.search([query], top_k, nprobe=nprobe)[0]
+        latencies.append((time.perf_counter() - callStartTime) * 1000)
+        ids.append([hit["id"] for hit in hits])
+    return ids, latencies, time.perf_counter() - startTime
+
+def recall(ids, exact_ids, top_k):
+    return sum(len(set(found) & set(expected)) for found, expected in zip(ids, exact_ids)) / (top_k * len(exact_ids))
+
+def bytes_per_vector(dim, vector_type, index_type):
+    # Vector data only, without the ids and the inverted lists
+    if index_type == "IVF_SQ8":
+        return dim
+    if index_type == "IVF_PQ":
+        return index_params("IP", 1, dim, "IVF_PQ")["params"]["m"]
+    return dim * (2 if vector_type == "float16" else 4)
+
+def local_store(corpus, metric, index, vector_type, projection, nlist):
+    store = LocalStore(None, metric, index, dtype=np.float16 if vector_type == "float16" else np.float32, projection=projection)
+    store.create_index({"params": {"nlist": nlist}})
+    store.add(corpus, [""] * len(corpus), ids=list(range(len(corpus))))
+    return store
+
+def milvus_store(corpus, metric, dim, vector_type, index_type, projection, nlist, insert_chunk):
+    from pymilvus import Collection, CollectionSchema, DataType, FieldSchema, utility
+    if utility.has_collection(EVALUATION_COLLECTION):
+        utility.drop_collection(EVALUATION_COLLECTION)
+    fields = [
+        FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=False),
+        FieldSchema(name="text", dtype=DataType.VARCHAR, max_length=1),
+        vector_field(dim, vector_type=vector_type)
+    ]
+    store = MilvusStore(Collection(EVALUATION_COLLECTION, CollectionSchema(fields, "Recall evaluation")), "id", "text", metric, projection=projection)
+    for start in range(0, len(corpus), insert_chunk):
+        chunk = corpus[start:start + insert_chunk]
+        store.add(chunk, [""] * len(chunk), ids=list(range(start, start + len(chunk))))
+    store.flush()
+    store.create_index(index_params(metric, nlist, dim, index_type))
+    store.load()
+    return store
+
+def evaluate(args):
+    embeddings = np.load(args.embeddings, mmap_mode="r")
+    if args.queries:
+        corpus, queries = np.asarray(embeddings, dtype=np.float32), np.load(args.queries).astype(np.float32)
+    else:
+        corpus, queries = split_queries(np.asarray(embeddings, dtype=np.float32), args.query_count)
+    full_dim = corpus.shape[1]
+    print(f"{len(corpus)} vectors of {full_dim} dimensions, {len(queries)} queries", file=sys.stderr)
+
+    # Exact float32 search over the full-dimensional vectors is the baseline
+    exact_ids, _, _ = search_all(local_store(corpus, args.metric, "flat", "float32", None, args.nlist), queries, args.top_k, args.nprobe)
+
+    if args.milvus_uri:
+        connect_milvus(args.milvus_uri)
+    results = []
+    # The full dimension stands for no projection
+    for dim in sorted({min(dim, full_dim) for dim in args.dims}, reverse=True):
+        projection = fit(corpus, dim) if dim < full_dim else None
+        for vector_type in args.types:
+            combinations = [("local", args.local_index)] + ([("milvus", index_type) for index_type in args.indexes] if args.milvus_uri else [])
+            for store_name, index_type in combinations:
+                if store_name == "local":
+                    store = local_store(corpus, args.metric, index_type, vector_type, projection, args.nlist)
+                else:
+                    store = milvus_store(corpus, args.metric, dim, vector_type, index_type, projection, args.nlist, args.insert_chunk)
+                ids, latencies, duration = search_all(store, queries, args.top_k, args.nprobe)
+                name = f"recall/{store_name}/{index_type}/dim={dim}/{vector_type}"
+                results.append(summarize(
+                    name, latencies, len(queries), duration, "queries/s",
+                    recall=round(recall(ids, exact_ids, args.top_k), 4),
+                    bytes_per_vector=bytes_per_vector(dim, vector_type, index_type if store_name == "milvus" else None),
+                    explained_variance=round(projection.explained_variance, 4) if projection else 1.0
+                ))
+                print(f"{name:<40} recall@{args.top_k} {results[-1]['recall']}", file=sys.stderr)
+
+    if args.milvus_uri:
+        from pymilvus import utility
+        utility.drop_collection(EVALUATION_COLLECTION)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k of projected, float16 and quantized vectors against exact full-precision search")
+    parser.add_argument("embeddings", help=".npy file of full-dimensional embeddings, one per row")
+    parser.add_argument("--queries", help=".npy file of query embeddings, instead of rows held out of the embeddings")
+    parser.add_argument("--query-count", type=int, default=200, help="rows held out as queries without --queries")
+    parser.add_argument("--dims", type=lambda value: [int(dim) for dim in value.split(",")], default=[768, 256, 128], help="comma-separated dimensions, the full one skips the projection")
+    parser.add_argument("--types", type=lambda value: value.split(","), default=["float32", "float16"], help="comma-separated vector types")
+    parser.add_argument("--metric", choices=("IP", "COSINE", "L2"), default="IP", help="IP for code_embeddings_py, COSINE for the sentence collections")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--local-index", choices=("flat", "ivf"), default="flat", help="index of the local vector store")
+    parser.add_argument("--milvus-uri", default=MILVUS_URI, help="also evaluate the Milvus --indexes, a local file path uses Milvus Lite")
+    parser.add_argument("--indexes", type=lambda value: value.split(","), default=["IVF_FLAT", "IVF_SQ8", "IVF_PQ"], help="comma-separated Milvus indexes")
+    parser.add_argument("--nlist", type=int, default=128)
+    parser.add_argument("--nprobe", type=int, default=10)
+    parser.add_argument("--insert-chunk", type=int, default=1024)
+    parser.add_argument("--min-recall", type=float, help="exit with 1 when a combination has a lower recall")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    startTime = time.time()
+    results = evaluate(args)
+    report = {
+        "suite": "recall",
+        "started_at": round(startTime, 3),
+        "duration_s": round(time.time() - startTime, 3),
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.min_recall is not None:
+        below = [result["name"] for result in results if result["recall"] < args.min_recall]
+        for name in below:
+            print(f"Recall below {args.min_recall}: {name}", file=sys.stderr)
+        if below:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,19 @@
 from transformers import AutoTokenizer, AutoModel
+import argparse
+import os
 import torch
 # from pymilvus import connections, FieldSchema, CollectionSchema, DataType, Collection
-from pymilvus import connections, utility, FieldSchema, CollectionSchema, DataType, Collection
+from pymilvus import FieldSchema, CollectionSchema, DataType
+from incremental_sync import sync
+from projection import require_projection
+from vector_store import index_params, open_store, vector_field
 
+# Run with --incremental to only embed the added and modified snippets instead of
+# re-creating the collection
+parser = argparse.ArgumentParser()
+parser.add_argument("--incremental", action="store_true", help="sync the collection instead of re-creating it")
+parser.add_argument("--manifest", default="code_embeddings_py.manifest.json", help="manifest of the incremental sync")
+args = parser.parse_args()
 
 # Load the tokenizer and model
 tokenizer = AutoTokenizer.from_pretrained("microsoft/codebert-base")
@@ -16,29 +27,6 @@ def generate_embedding(text):
         outputs = model(**inputs)
     return outputs.last_hidden_state[:, 0, :].squeeze().numpy()
 
-# Connect to Milvus
-connections.connect("default", host="localhost", port="19530")
-
-# Define the collection schema
-fields = [
-    FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
-    FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=768),
-    FieldSchema(name="code_snippet", dtype=DataType.VARCHAR, max_length=65535)
-]
-schema = CollectionSchema(fields, "Code Embeddings Collection")
-
-# Define the collection name
-collection_name = "code_embeddings_py"
-
-# Check if the collection exists
-if utility.has_collection(collection_name):
-    # Drop the existing collection
-    utility.drop_collection(collection_name)
-    print(f"Collection '{collection_name}' dropped.")
-
-# Create the collection
-collection = Collection("code_embeddings_py", schema)
-
 # Example list of code snippets
 code_snippets = [
     "public int Add(int a, int b) { return a + b; }",
@@ -63,37 +51,57 @@ code_snippets = [
     "public string GetDayOfWeek(DateTime date) { return date.DayOfWeek.ToString(); }"
 ];
 
-# Generate embeddings
-embeddings = [generate_embedding(code) for code in code_snippets]
+# Reduce the embeddings with the PCA projection of the collection when PROJECTION_DIM is set,
+# fitted beforehand with projection.py or bulk-index.py
+collection_name = "code_embeddings_py"
+projection = require_projection(collection_name)
+dim = projection.dim if projection else 768
+
+# Define the collection schema, the embedding field is float16 with VECTOR_TYPE=float16
+fields = [
+    FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
+    vector_field(dim),
+    FieldSchema(name="code_snippet", dtype=DataType.VARCHAR, max_length=65535)
+]
+schema = CollectionSchema(fields, "Code Embeddings Collection")
+
+# Open the collection in the vector store selected with VECTOR_STORE (Milvus by default, see
+# vector_store.py), dropping the existing one unless it is synced incrementally. A collection
+# without a manifest holds rows the sync does not know about, so it is dropped as well. The
+# store projects the embeddings it inserts and the queries it searches for.
+rebuild = not args.incremental or not os.path.exists(args.manifest)
+store, collection_exists = open_store(collection_name, schema, metric="IP", id_field="id", text_field="code_snippet", drop=rebuild, projection=projection)
 
-# Insert embeddings and code snippets into Milvus
-collection.insert([embeddings, code_snippets])
+# Only embed the snippets that changed since the last sync, a rebuild embeds all of them and
+# writes the manifest the next --incremental run starts from. A snippet is its own key, so an
+# edited snippet is deleted and added again rather than updated.
+report = sync(
+    {code: code for code in dict.fromkeys(code_snippets)},
+    args.manifest,
+    {"collection": collection_name, "model": "microsoft/codebert-base", "pooling": "cls", "projection": projection.fingerprint() if projection else None},
+    embed=lambda snippets: [generate_embedding(code) for code in snippets],
+    insert=lambda keys, snippets, embeddings: store.add(embeddings, snippets),
+    delete=store.delete,
+    reset=rebuild or not collection_exists
+)
+print(f"Synced collection '{collection_name}': {report}")
+if report["added"] or report["updated"] or report["deleted"]:
+    store.flush()
 
-# Create an index on the embedding field
-index_params = {
-    "index_type": "IVF_FLAT",
-    "metric_type": "IP",  # Inner Product
-    "params": {"nlist": 128}
-}
-collection.create_index(field_name="embedding", index_params=index_params)
+# Create an index on the embedding field, IVF_FLAT unless VECTOR_INDEX is IVF_SQ8 or IVF_PQ
+store.create_index(index_params("IP", 128, dim))  # Inner Product
 
 # Load the collection into memory
-collection.load()
+store.load()
 
 # Function to search for code snippets
 def search_code(query, top_k=2):
     query_embedding = generate_embedding(query)
-    search_params = {"metric_type": "IP", "params": {"nprobe": 10}}
-    results = collection.search(
-        data=[query_embedding],
-        anns_field="embedding",
-        param=search_params,
-        limit=top_k,
-        output_fields=["code_snippet"]  # Specify the field to retrieve
-    )
+    # The store applies the projection of the collection to the query, like to the snippets
+    results = store.search([query_embedding], top_k, nprobe=10)
     for result in results[0]:
-        print(f"Similarity Score: {result.score}")
-        print(f"Code Snippet: {result.entity.get('code_snippet')}\n")
+        print(f"Similarity Score: {result['score']}")
+        print(f"Code Snippet: {result['text']}\n")
 
 # Example query
 search_code("what function is used to sort the elements of an array?")
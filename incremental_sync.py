@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+
+# Incremental sync of a corpus into a vector store collection. A local manifest remembers the
+# content hash and the primary keys of every indexed snippet, so a sync only embeds and inserts
+# the added and modified snippets, deletes the removed ones and leaves the collection alone when
+# nothing changed. When the settings (model, collection, pooling) change, everything is
+# embedded again.
+
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def load_manifest(path):
+    if os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
+    return {"settings": None, "items": {}}
+
+def save_manifest(path, manifest):
+    # Replace the file atomically, an interrupted write must not lose the manifest
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file)
+    os.replace(path + ".tmp", path)
+
+def sync(items, manifest_path, settings, embed, insert, delete, reset=False):
+    # items maps a stable key of every snippet to its content,
+    # embed(contents) returns their embeddings,
+    # insert(keys, contents, embeddings) inserts them and returns their primary keys,
+    # delete(primary_keys) removes rows from the collection
+    manifest = load_manifest(manifest_path)
+    previous = manifest["items"]
+    if reset:
+        # The collection was created from scratch, nothing of the manifest is indexed any more
+        previous = {}
+    elif manifest["settings"] != settings and previous:
+        print("The settings changed since the last sync, re-embedding every snippet")
+        delete([primary_key for item in previous.values() for primary_key in item["ids"]])
+        previous = {}
+
+    hashes = {key: content_hash(content) for key, content in items.items()}
+    changed = [key for key in items if key not in previous or previous[key]["hash"] != hashes[key]]
+    removed = [key for key in previous if key not in items]
+    report = {
+        "skipped": len(items) - len(changed),
+        "added": sum(1 for key in changed if key not in previous),
+        "updated": sum(1 for key in changed if key in previous),
+        "deleted": len(removed)
+    }
+
+    # Remove the rows of the deleted snippets and the outdated rows of the modified ones
+    outdated = [primary_key for key in removed + changed if key in previous for primary_key in previous[key]["ids"]]
+    if outdated:
+        delete(outdated)
+
+    synced = {key: item for key, item in previous.items() if key in items and key not in changed}
+    if changed:
+        contents = [items[key] for key in changed]
+        primary_keys = insert(changed, contents, embed(contents))
+        for key, primary_key in zip(changed, primary_keys):
+            synced[key] = {"hash": hashes[key], "ids": [primary_key]}
+
+    save_manifest(manifest_path, {"settings": settings, "items": synced})
+    return report
@@ -0,0 +1,170 @@
+# Inference backends returning the [CLS] embeddings of a padded batch:
+# - torch: eager fp32 PyTorch
+# - onnx: the model exported to an ONNX Runtime graph
+# - onnx-int8: the ONNX graph with dynamically int8-quantized weights
+#
+# The weights are loaded from model_path when it is set (a snapshot saved by download-codebert.py,
+# safetensors files are memory-mapped), otherwise from the hub at the given revision.
+# The ONNX graphs are exported once into ONNX_CACHE_DIR, under the identity of the weights they
+# were exported from, either on first use or with `python inference_backend.py export`, and `python inference_backend.py parity --backend onnx-int8`
+# reports the cosine similarity of a backend against the fp32 PyTorch reference.
+
+from os import environ, getpid, makedirs, path
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+from model_snapshot import model_identity
+
+INFERENCE_BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_CACHE_DIR = environ.get("ONNX_CACHE_DIR", "onnx-models")
+
+class TorchBackend:
+    def __init__(self, model):
+        # Inference mode: disables dropout
+        self.model = model.eval()
+        self.hidden_size = model.config.hidden_size
+
+    def cls_embeddings(self, input_ids, attention_mask):
+        with torch.no_grad():
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, 0, :]
+
+class OnnxBackend:
+    def __init__(self, model_path, hidden_size):
+        self.model_path = model_path
+        self.hidden_size = hidden_size
+        self.session = None
+        self.session_pid = None
+
+    def cls_embeddings(self, input_ids, attention_mask):
+        outputs = self._session().run(["cls_embedding"], {
+            "input_ids": input_ids.numpy(),
+            "attention_mask": attention_mask.numpy()
+        })
+        return torch.from_numpy(outputs[0])
+
+    def _session(self):
+        # ONNX Runtime thread pools do not survive a fork, so every worker process creates its
+        # own session, using the torch thread count the worker was configured with
+        if self.session is None or self.session_pid != getpid():
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = onnxruntime.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+            self.session_pid = getpid()
+        return self.session
+
+# Only the [CLS] embedding leaves the graph, instead of the hidden states of every token
+class ClsEmbedding(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, 0, :]
+
+def onnx_path(model_name, backend, cache_dir=ONNX_CACHE_DIR, model_path=None, revision=None):
+    # A graph exported from other weights of the model lives in another directory
+    file_name = "model-int8.onnx" if backend == "onnx-int8" else "model.onnx"
+    identity = model_identity(model_path, revision).replace("=", "-").replace("/", "--")
+    return path.join(cache_dir, model_name.replace("/", "--"), identity, file_name)
+
+def pretrained(model_name, model_path=None, revision=None):
+    # Arguments of from_pretrained: a local snapshot never touches the hub
+    if model_path:
+        return model_path, {"local_files_only": True}
+    return model_name, {"revision": revision}
+
+def export_onnx(model_name, cache_dir=ONNX_CACHE_DIR, model_path=None, revision=None):
+    fp32_path = onnx_path(model_name, "onnx", cache_dir, model_path, revision)
+    int8_path = onnx_path(model_name, "onnx-int8", cache_dir, model_path, revision)
+    makedirs(path.dirname(fp32_path), exist_ok=True)
+
+    if not path.exists(fp32_path):
+        startTime = time.time()
+        source, options = pretrained(model_name, model_path, revision)
+        model = AutoModel.from_pretrained(source, **options).eval()
+        dummy_input_ids = torch.ones((2, 16), dtype=torch.long)
+        dummy_attention_mask = torch.ones((2, 16), dtype=torch.long)
+        with torch.no_grad():
+            torch.onnx.export(
+                ClsEmbedding(model),
+                (dummy_input_ids, dummy_attention_mask),
+                fp32_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["cls_embedding"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "cls_embedding": {0: "batch"}
+                },
+                opset_version=14
+            )
+        print(f"Exported {model_name} to {fp32_path} in {round(time.time() - startTime, 2)} s")
+
+    if not path.exists(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        startTime = time.time()
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        print(f"Quantized {fp32_path} to {int8_path} in {round(time.time() - startTime, 2)} s")
+
+def load_backend(model_name, backend="torch", cache_dir=ONNX_CACHE_DIR, model_path=None, revision=None):
+    source, options = pretrained(model_name, model_path, revision)
+    if backend == "torch":
+        return TorchBackend(AutoModel.from_pretrained(source, **options))
+    if backend in ("onnx", "onnx-int8"):
+        graph_path = onnx_path(model_name, backend, cache_dir, model_path, revision)
+        if not path.exists(graph_path):
+            export_onnx(model_name, cache_dir, model_path, revision)
+        return OnnxBackend(graph_path, AutoConfig.from_pretrained(source, **options).hidden_size)
+    raise ValueError(f"Unknown inference backend: {backend}, expected one of {', '.join(INFERENCE_BACKENDS)}")
+
+# Code snippets and queries the parity check embeds with both backends
+PARITY_SAMPLES = [
+    "public int Add(int a, int b) { return a + b; }",
+    "public bool IsPalindrome(string word) { string reversed = new string(word.Reverse().ToArray()); return word.Equals(reversed, StringComparison.OrdinalIgnoreCase); }",
+    "public bool IsPrime(int number) { if (number <= 1) return false; for (int i = 2; i <= Math.Sqrt(number); i++) { if (number % i == 0) return false; } return true; }",
+    "public double CalculateDistance(double x1, double y1, double x2, double y2) { return Math.Sqrt(Math.Pow(x2 - x1, 2) + Math.Pow(y2 - y1, 2)); }",
+    "what function is used to sort the elements of an array?",
+    "how do I publish a message in rabbitmq?"
+]
+
+def parity_check(model_name, backend, cache_dir=ONNX_CACHE_DIR, model_path=None, revision=None, iterations=5):
+    source, options = pretrained(model_name, model_path, revision)
+    tokenizer = AutoTokenizer.from_pretrained(source, **options)
+    batch = tokenizer(PARITY_SAMPLES, padding=True, truncation=True, max_length=512, return_tensors="pt")
+
+    results = {}
+    candidates = (
+        ("torch", load_backend(model_name, "torch", cache_dir, model_path, revision)),
+        (backend, load_backend(model_name, backend, cache_dir, model_path, revision))
+    )
+    for name, candidate in candidates:
+        embeddings = candidate.cls_embeddings(batch["input_ids"], batch["attention_mask"])
+        startTime = time.time()
+        for _ in range(iterations):
+            candidate.cls_embeddings(batch["input_ids"], batch["attention_mask"])
+        results[name] = (embeddings, (time.time() - startTime) / iterations * 1000)
+
+    similarities = F.cosine_similarity(results["torch"][0], results[backend][0], dim=1)
+    print(f"Cosine similarity of {backend} against the fp32 torch reference: min {similarities.min().item():.6f}, mean {similarities.mean().item():.6f}")
+    print(f"Batch latency: torch {round(results['torch'][1], 2)} ms, {backend} {round(results[backend][1], 2)} ms")
+    return similarities
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the ONNX graphs of a model and check their parity")
+    parser.add_argument("command", choices=("export", "parity"))
+    parser.add_argument("--model", default="microsoft/codebert-base")
+    parser.add_argument("--backend", choices=INFERENCE_BACKENDS, default="onnx-int8")
+    parser.add_argument("--cache-dir", default=ONNX_CACHE_DIR)
+    # The same snapshot or revision as the workers, which load the graphs exported from it
+    parser.add_argument("--model-path", default=environ.get("MODEL_PATH"), help="local snapshot of the model (default: MODEL_PATH)")
+    parser.add_argument("--revision", default=environ.get("MODEL_REVISION"), help="hub revision of the model (default: MODEL_REVISION)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx(args.model, args.cache_dir, args.model_path, args.revision)
+    else:
+        parity_check(args.model, args.backend, args.cache_dir, args.model_path, args.revision)
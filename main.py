@@ -1,13 +1,41 @@
-from os import environ
+from os import environ, cpu_count, getpid, kill, path, remove, replace
+from multiprocessing.connection import wait
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import bisect
+import multiprocessing
+import random
+import signal
+import threading
 import time
 import pika
 import json
-import torch
-import torch.nn.functional as F
-from transformers import AutoTokenizer, AutoModel
+from pika.adapters.select_connection import IOLoop
+from embedding_cache import EmbeddingCache
+from model_registry import MeanPoolingModel, ModelRegistry
+from model_snapshot import model_identity
+from response_encoding import RESPONSE_ENCODINGS, encode_embedding
+from telemetry import Counter, Gauge, Histogram, log, profiler, readiness, start_metrics_server
 
-tokenizer = AutoTokenizer.from_pretrained("microsoft/codebert-base")
-model = AutoModel.from_pretrained("microsoft/codebert-base")
+processStartTime = time.time()
+
+MODEL_NAME = "microsoft/codebert-base"
+
+# Model snapshot: MODEL_PATH loads the tokenizer and the weights from a local directory saved by
+# download-codebert.py, without touching the Hugging Face hub; otherwise MODEL_NAME is loaded
+# from the hub at MODEL_REVISION (a tag or commit hash, default: the latest one)
+MODEL_PATH = environ.get("MODEL_PATH")
+MODEL_REVISION = environ.get("MODEL_REVISION")
+
+# Inference backend: torch (eager fp32), onnx or onnx-int8 (dynamically quantized ONNX Runtime graph)
+INFERENCE_BACKEND = environ.get("INFERENCE_BACKEND", "torch")
+
+# torch, transformers and the model are loaded by load_model(), not when this module is imported
+torch = None
+F = None
+tokenizer = None
+backend = None
+startup_timings = {}
 
 RABBITMQ_HOST = environ.get("RABBITMQ_HOST", "localhost")
 RABBITMQ_PORT = environ.get("RABBITMQ_PORT", 5672)
@@ -18,98 +46,900 @@ RABBITMQ_VHOST = environ.get("RABBITMQ_VHOST", "/")
 RABBITMQ_REQUESTS_EXCHANGE = "embeddings_requests"
 RABBITMQ_REQUESTS_QUEUE = "embeddings_requests"
 
+# Priority lanes: query and code requests published with the routing key query or code land
+# in their own queue, the legacy queue (routing key "") is still consumed and its messages are
+# sorted into the lanes by type. The query lane is served first, and while queries are waiting
+# the code lane still gets CODE_LANE_SHARE of the recent inference time
+RABBITMQ_QUERY_REQUESTS_QUEUE = "query_embedding_requests"
+RABBITMQ_CODE_REQUESTS_QUEUE = "code_embedding_requests"
+LANES = ("query", "code")
+CODE_LANE_SHARE = float(environ.get("CODE_LANE_SHARE", 0.2))
+# Weight of the inference time of past batches in the lane shares, per batch
+LANE_SHARE_DECAY = 0.9
+QUEUE_DEPTH_INTERVAL = float(environ.get("QUEUE_DEPTH_INTERVAL", 5))
+
 RABBITMQ_RESPONSES_EXCHANGE = "embeddings_responses"
 RABBITMQ_CODE_RESPONSES_QUEUE = "code_embedding_responses"
 RABBITMQ_QUERY_RESPONSES_QUEUE = "query_embedding_responses"
 
-def connect_to_rabbitmq():
+# Resilience: a request whose embedding fails is published again with its attempts counted in
+# the REQUEST_ATTEMPTS_HEADER header, invalid requests and requests failing REQUEST_MAX_ATTEMPTS
+# times are rejected, to RABBITMQ_DEAD_LETTER_EXCHANGE when it is set (the request queues are
+# then declared with it, which the broker refuses for queues that exist without it). A lost
+# connection is reopened after RECONNECT_DELAY seconds doubling up to RECONNECT_MAX_DELAY, and
+# a shutdown waits up to CONFIRM_TIMEOUT seconds for the publisher confirms of the last responses
+RABBITMQ_HEARTBEAT = int(environ.get("RABBITMQ_HEARTBEAT", 60))
+RABBITMQ_DEAD_LETTER_EXCHANGE = environ.get("RABBITMQ_DEAD_LETTER_EXCHANGE", "")
+RABBITMQ_DEAD_LETTER_QUEUE = environ.get("RABBITMQ_DEAD_LETTER_QUEUE", "embeddings_dead_letters")
+REQUEST_ATTEMPTS_HEADER = "x-embedify-attempts"
+REQUEST_MAX_ATTEMPTS = int(environ.get("REQUEST_MAX_ATTEMPTS", 2))
+RECONNECT_DELAY = float(environ.get("RECONNECT_DELAY", 1))
+RECONNECT_MAX_DELAY = float(environ.get("RECONNECT_MAX_DELAY", 30))
+CONFIRM_TIMEOUT = float(environ.get("CONFIRM_TIMEOUT", 30))
+
+# Micro-batching: buffer up to BATCH_MAX_SIZE deliveries or BATCH_WINDOW_MS milliseconds
+# and embed each request type of the batch in a single forward pass
+BATCH_MAX_SIZE = int(environ.get("BATCH_MAX_SIZE", 1))
+BATCH_WINDOW_MS = float(environ.get("BATCH_WINDOW_MS", 20))
+BATCH_PREFETCH = int(environ.get("BATCH_PREFETCH", BATCH_MAX_SIZE * 2))
+
+# Chunking: code is split into overlapping windows of CODE_CHUNK_SIZE tokens, at most
+# MAX_CHUNKS_PER_REQUEST windows per request, and the model runs on at most
+# MAX_INFERENCE_BATCH windows per forward pass
+QUERY_MAX_LENGTH = 128
+CODE_CHUNK_SIZE = 512
+CODE_CHUNK_OVERLAP = int(environ.get("CODE_CHUNK_OVERLAP", 50))
+MAX_CHUNKS_PER_REQUEST = int(environ.get("MAX_CHUNKS_PER_REQUEST", 16))
+MAX_INFERENCE_BATCH = int(environ.get("MAX_INFERENCE_BATCH", 32))
+
+# Dynamic padding: windows are grouped into these length buckets and every forward pass is
+# padded only to the longest window of its batch
+PADDING_BUCKETS = sorted(int(length) for length in environ.get("PADDING_BUCKETS", "32,64,128,256,512").split(","))
+
+# Embedding cache: an in-process LRU tier of EMBEDDING_CACHE_MAX_MB megabytes and an optional
+# SQLite file at EMBEDDING_CACHE_PATH, both disabled when the budget is 0 and no path is set
+EMBEDDING_CACHE_MAX_MB = float(environ.get("EMBEDDING_CACHE_MAX_MB", 128))
+EMBEDDING_CACHE_PATH = environ.get("EMBEDDING_CACHE_PATH")
+
+# Every setting that changes the embedding of a content is part of the cache fingerprint,
+# including the model weights, so a new revision or snapshot does not serve old embeddings
+EMBEDDING_SETTINGS = f"{MODEL_NAME}|{model_identity(MODEL_PATH, MODEL_REVISION)}|{INFERENCE_BACKEND}|cls-max|{QUERY_MAX_LENGTH}|{CODE_CHUNK_SIZE}|{CODE_CHUNK_OVERLAP}|{MAX_CHUNKS_PER_REQUEST}"
+embedding_cache = None
+if EMBEDDING_CACHE_MAX_MB > 0 or EMBEDDING_CACHE_PATH:
+    embedding_cache = EmbeddingCache(EMBEDDING_SETTINGS, int(EMBEDDING_CACHE_MAX_MB * 1024 * 1024), EMBEDDING_CACHE_PATH)
+
+# Model registry: a request picks one of EMBEDIFY_MODELS with its `model` field (default:
+# codebert). SBERT (all-MiniLM-L6-v2, mean pooling, 384 dimensions) is loaded on its first
+# request, from SBERT_MODEL_PATH when set, and its responses are routed with sbert.<type>.
+# Models other than codebert are unloaded, least recently used first, when the loaded models
+# exceed MODEL_MEMORY_MB, or after MODEL_IDLE_S seconds without a request (0 disables either)
+DEFAULT_MODEL = "codebert"
+EMBEDIFY_MODELS = [name.strip() for name in environ.get("EMBEDIFY_MODELS", "codebert,sbert").split(",")]
+SBERT_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+SBERT_MODEL_PATH = environ.get("SBERT_MODEL_PATH")
+SBERT_MAX_LENGTH = 256
+MODEL_MEMORY_MB = float(environ.get("MODEL_MEMORY_MB", 2048))
+MODEL_IDLE_S = float(environ.get("MODEL_IDLE_S", 0))
+RABBITMQ_SBERT_RESPONSES_QUEUE = "sbert_embedding_responses"
+
+# Worker pool: `--workers N` forks N consumer processes sharing the model weights loaded by
+# the supervisor, each using TORCH_THREADS threads (default: the cores split between workers)
+EMBEDIFY_WORKERS = int(environ.get("EMBEDIFY_WORKERS", 1))
+TORCH_THREADS = environ.get("TORCH_THREADS")
+WORKER_RESTART_DELAY = float(environ.get("WORKER_RESTART_DELAY", 1))
+WORKER_SHUTDOWN_TIMEOUT = float(environ.get("WORKER_SHUTDOWN_TIMEOUT", 30))
+
+# Metrics: every worker serves GET /metrics and the GET /ready probe on METRICS_PORT plus its
+# slot (0 disables it)
+METRICS_PORT = int(environ.get("METRICS_PORT", 9108))
+
+# Startup: WARMUP runs a forward pass at every padding bucket length and batch shape before
+# the worker consumes, and READINESS_FILE is written once the worker consumes; with --workers,
+# every worker writes READINESS_FILE.<slot> and the supervisor writes READINESS_FILE while all
+# of them consume
+WARMUP = environ.get("WARMUP", "1") == "1"
+READINESS_FILE = environ.get("READINESS_FILE")
+
+STAGE_SECONDS = Histogram("embedify_stage_seconds", "Duration of a processing stage, per batch for tokenize, infer and pool, per message for serialize and publish", ("stage", "type"))
+QUEUE_WAIT_SECONDS = Histogram("embedify_queue_wait_seconds", "Time between the delivery of a message and the start of its batch", ("type",))
+CHUNKS_PER_REQUEST = Histogram("embedify_chunks_per_request", "Chunks a request was split into", ("type",), buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_SIZE = Histogram("embedify_batch_size", "Messages per processed batch", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+MESSAGES = Counter("embedify_messages_total", "Processed messages by outcome: ok, rejected, retried, failed or requeued", ("type", "outcome"))
+CONFIRMS = Counter("embedify_publisher_confirms_total", "Publisher confirms received from the broker, each may cover several responses", ("result",))
+RECONNECTS = Counter("embedify_reconnects_total", "Reconnections to RabbitMQ")
+QUEUE_DEPTH = Gauge("embedify_queue_depth", "Ready messages of a request queue, polled from the broker", ("queue",))
+LANE_BUFFERED = Gauge("embedify_lane_buffered_messages", "Messages delivered to the worker and waiting for a batch, per lane", ("lane",))
+LANE_BATCHES = Counter("embedify_lane_batches_total", "Batches run per lane", ("lane",))
+LANE_INFERENCE_SECONDS = Counter("embedify_lane_inference_seconds_total", "Inference time spent per lane", ("lane",))
+REQUEST_SECONDS = Histogram("embedify_request_seconds", "Time between the delivery of a request and the confirm of its response, per lane", ("lane",))
+TOKENS = Counter("embedify_tokens_total", "Real and padded tokens run through the model", ("kind",))
+IN_FLIGHT = Gauge("embedify_in_flight_messages", "Messages delivered to the worker and not acknowledged yet")
+MODEL_LOAD_SECONDS = Gauge("embedify_model_load_seconds", "Time spent loading the tokenizer and the model")
+STARTUP_SECONDS = Gauge("embedify_startup_seconds", "Duration of the startup phases of the worker", ("phase",), collect=lambda: startup_timings)
+Gauge("embedify_embedding_cache", "Counters and size of the embedding cache", ("counter",), collect=lambda: embedding_cache.counters() if embedding_cache is not None else {})
+
+batch_stats = {"batches": 0, "messages": 0}
+stop_consuming = threading.Event()
+
+def load_model():
+    # Import torch and transformers and load the tokenizer and the model once per process;
+    # the supervisor of a worker pool loads them before forking so the workers share them
+    global torch, F, tokenizer, backend
+    if backend is not None:
+        return
+
+    startTime = time.time()
+    import torch
+    import torch.nn.functional as F
+    from transformers import AutoTokenizer
+    from inference_backend import load_backend
+    startup_timings["import"] = round(time.time() - startTime, 3)
+
+    source = MODEL_PATH or MODEL_NAME
+    options = {"local_files_only": True} if MODEL_PATH else {"revision": MODEL_REVISION}
+    startTime = time.time()
+    tokenizer = AutoTokenizer.from_pretrained(source, **options)
+    startup_timings["tokenizer"] = round(time.time() - startTime, 3)
+
+    startTime = time.time()
+    backend = load_backend(MODEL_NAME, INFERENCE_BACKEND, model_path=MODEL_PATH, revision=MODEL_REVISION)
+    startup_timings["model"] = round(time.time() - startTime, 3)
+    MODEL_LOAD_SECONDS.set(round(startup_timings["tokenizer"] + startup_timings["model"], 3))
+    log("model_loaded", f"Loaded {source} with the {INFERENCE_BACKEND} backend in {round(startup_timings['tokenizer'] + startup_timings['model'], 2)} s", source=source, **startup_timings)
+
+def warm_up():
+    # One forward pass per padding bucket at a single window and at the largest batch, so the
+    # first requests do not pay for lazy allocations, kernel selection or ONNX session creation
+    startTime = time.time()
+    batchSizes = sorted({1, max(1, min(BATCH_MAX_SIZE, MAX_INFERENCE_BATCH))})
+    for length in PADDING_BUCKETS:
+        for batchSize in batchSizes:
+            input_ids = torch.full((batchSize, length), tokenizer.unk_token_id, dtype=torch.long)
+            input_ids[:, 0] = tokenizer.cls_token_id
+            input_ids[:, -1] = tokenizer.sep_token_id
+            backend.cls_embeddings(input_ids, torch.ones_like(input_ids))
+    startup_timings["warmup"] = round(time.time() - startTime, 3)
+    log("warmed_up", f"Warmed up {len(PADDING_BUCKETS) * len(batchSizes)} batch shapes in {round(startup_timings['warmup'], 2)} s", shapes=len(PADDING_BUCKETS) * len(batchSizes))
+
+def readiness_path(slot=None):
+    # The readiness file of a worker of the pool, or of the single worker
+    return READINESS_FILE if slot is None else f"{READINESS_FILE}.{slot}"
+
+def write_readiness(filePath, status):
+    # Replace the file atomically, a probe must never read it half written
+    with open(f"{filePath}.{getpid()}.tmp", "w") as file:
+        json.dump(status, file)
+    replace(f"{filePath}.{getpid()}.tmp", filePath)
+
+def remove_readiness(filePath):
+    try:
+        remove(filePath)
+    except FileNotFoundError:
+        pass
+
+def mark_ready(workerStartTime, slot=None):
+    startup_timings["ready"] = round(time.time() - workerStartTime, 3)
+    readiness.update(startup_timings, ready=True, pid=getpid())
+    if READINESS_FILE:
+        write_readiness(readiness_path(slot), readiness)
+
+def connection_parameters():
     credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_VHOST, credentials))
-    channel = connection.channel()
+    return pika.ConnectionParameters(RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_VHOST, credentials, heartbeat=RABBITMQ_HEARTBEAT)
 
-    channel.exchange_declare(exchange=RABBITMQ_REQUESTS_EXCHANGE, exchange_type="direct")
-    channel.queue_declare(queue=RABBITMQ_REQUESTS_QUEUE)
-    channel.queue_bind(exchange=RABBITMQ_REQUESTS_EXCHANGE, queue=RABBITMQ_REQUESTS_QUEUE, routing_key="")
+def topology():
+    # The exchanges, queues and bindings to declare, in order, as (channel method, arguments);
+    # rejected requests are dead-lettered to RABBITMQ_DEAD_LETTER_EXCHANGE when it is set
+    steps = []
+    requestArguments = None
+    if RABBITMQ_DEAD_LETTER_EXCHANGE:
+        requestArguments = {"x-dead-letter-exchange": RABBITMQ_DEAD_LETTER_EXCHANGE}
+        steps += [
+            ("exchange_declare", {"exchange": RABBITMQ_DEAD_LETTER_EXCHANGE, "exchange_type": "fanout"}),
+            ("queue_declare", {"queue": RABBITMQ_DEAD_LETTER_QUEUE}),
+            ("queue_bind", {"exchange": RABBITMQ_DEAD_LETTER_EXCHANGE, "queue": RABBITMQ_DEAD_LETTER_QUEUE, "routing_key": ""})
+        ]
 
-    channel.exchange_declare(exchange=RABBITMQ_RESPONSES_EXCHANGE, exchange_type="direct")
-    channel.queue_declare(queue=RABBITMQ_CODE_RESPONSES_QUEUE)
-    channel.queue_declare(queue=RABBITMQ_QUERY_RESPONSES_QUEUE)
-    channel.queue_bind(exchange=RABBITMQ_RESPONSES_EXCHANGE, queue=RABBITMQ_CODE_RESPONSES_QUEUE, routing_key="code")
-    channel.queue_bind(exchange=RABBITMQ_RESPONSES_EXCHANGE, queue=RABBITMQ_QUERY_RESPONSES_QUEUE, routing_key="query")
+    steps += [
+        ("exchange_declare", {"exchange": RABBITMQ_REQUESTS_EXCHANGE, "exchange_type": "direct"}),
+        ("queue_declare", {"queue": RABBITMQ_REQUESTS_QUEUE, "arguments": requestArguments}),
+        ("queue_bind", {"exchange": RABBITMQ_REQUESTS_EXCHANGE, "queue": RABBITMQ_REQUESTS_QUEUE, "routing_key": ""}),
+        ("queue_declare", {"queue": RABBITMQ_QUERY_REQUESTS_QUEUE, "arguments": requestArguments}),
+        ("queue_bind", {"exchange": RABBITMQ_REQUESTS_EXCHANGE, "queue": RABBITMQ_QUERY_REQUESTS_QUEUE, "routing_key": "query"}),
+        ("queue_declare", {"queue": RABBITMQ_CODE_REQUESTS_QUEUE, "arguments": requestArguments}),
+        ("queue_bind", {"exchange": RABBITMQ_REQUESTS_EXCHANGE, "queue": RABBITMQ_CODE_REQUESTS_QUEUE, "routing_key": "code"}),
 
+        ("exchange_declare", {"exchange": RABBITMQ_RESPONSES_EXCHANGE, "exchange_type": "direct"}),
+        ("queue_declare", {"queue": RABBITMQ_CODE_RESPONSES_QUEUE}),
+        ("queue_declare", {"queue": RABBITMQ_QUERY_RESPONSES_QUEUE}),
+        ("queue_bind", {"exchange": RABBITMQ_RESPONSES_EXCHANGE, "queue": RABBITMQ_CODE_RESPONSES_QUEUE, "routing_key": "code"}),
+        ("queue_bind", {"exchange": RABBITMQ_RESPONSES_EXCHANGE, "queue": RABBITMQ_QUERY_RESPONSES_QUEUE, "routing_key": "query"})
+    ]
+    if "sbert" in EMBEDIFY_MODELS:
+        steps += [
+            ("queue_declare", {"queue": RABBITMQ_SBERT_RESPONSES_QUEUE}),
+            ("queue_bind", {"exchange": RABBITMQ_RESPONSES_EXCHANGE, "queue": RABBITMQ_SBERT_RESPONSES_QUEUE, "routing_key": "sbert.code"}),
+            ("queue_bind", {"exchange": RABBITMQ_RESPONSES_EXCHANGE, "queue": RABBITMQ_SBERT_RESPONSES_QUEUE, "routing_key": "sbert.query"})
+        ]
+    return steps
+
+def connect_to_rabbitmq():
+    # Blocking connection for clients and tools, the worker consumes with Consumer
+    connection = pika.BlockingConnection(connection_parameters())
+    channel = connection.channel()
+    for method, arguments in topology():
+        getattr(channel, method)(**arguments)
     return channel
 
-def generate_embedding(content, requestType):
-    chunk_size = 512
-    overlap = 50  # Optional overlap for continuity across chunks
-    embeddings = []
+def build_windows(token_ids, body_length, overlap):
+    # Split the tokens of one input into windows of body_length tokens overlapping by
+    # overlap tokens, and wrap each window with the special tokens of the model
+    windows = []
+    start = 0
+    while True:
+        windows.append(tokenizer.build_inputs_with_special_tokens(token_ids[start:start + body_length]))
+        if start + body_length >= len(token_ids):
+            return windows
+        start += body_length - overlap
+
+def length_buckets(windows):
+    # Put every window into the smallest length bucket that fits it, and split each bucket
+    # into batches of at most MAX_INFERENCE_BATCH windows ordered by length
+    buckets = {}
+    for index, window in enumerate(windows):
+        bucket = bisect.bisect_left(PADDING_BUCKETS, len(window))
+        buckets.setdefault(bucket, []).append(index)
 
+    for bucket in sorted(buckets):
+        indices = sorted(buckets[bucket], key=lambda i: len(windows[i]))
+        for start in range(0, len(indices), MAX_INFERENCE_BATCH):
+            yield indices[start:start + MAX_INFERENCE_BATCH]
+
+def embed_windows(windows, requestType):
+    # Run the windows through the model bucket by bucket, each batch padded only to the
+    # length of its longest window, and count the real and padded tokens
+    window_embeddings = torch.empty(len(windows), backend.hidden_size)
+    padding = {"batches": 0, "tokens": 0, "padded_tokens": 0}
+
+    for indices in length_buckets(windows):
+        batch = tokenizer.pad({"input_ids": [windows[i] for i in indices]}, return_tensors="pt")
+        # [CLS] token pooling for every window of the batch
+        with STAGE_SECONDS.time(stage="infer", type=requestType):
+            cls_embeddings = backend.cls_embeddings(batch["input_ids"], batch["attention_mask"])
+        # Normalize each window embedding, in the order of the windows
+        window_embeddings[indices] = F.normalize(cls_embeddings, p=2, dim=1)
+
+        padding["batches"] += 1
+        padding["tokens"] += sum(len(windows[i]) for i in indices)
+        padding["padded_tokens"] += batch["input_ids"].numel()
+
+    TOKENS.inc(padding["tokens"], kind="real")
+    TOKENS.inc(padding["padded_tokens"] - padding["tokens"], kind="padding")
+    return window_embeddings, padding
+
+def tokenize_contents(contents, requestType):
     if requestType == "query":
-        # Process query as a single input with truncation for natural language queries
-        inputs = tokenizer(content, return_tensors="pt", max_length=128, truncation=True)
-        with torch.no_grad():
-            embedding = model(**inputs).last_hidden_state[:, 0, :].squeeze()
-            # Normalize the query embedding
-            embedding = F.normalize(embedding, p=2, dim=0)
-            embeddings.append(embedding)
+        # Process a query as a single window with truncation for natural language queries
+        max_length, overlap, max_chunks = QUERY_MAX_LENGTH, 0, 1
     else:  # Code
-        # Split code content into chunks of max 512 tokens with optional overlap
-        tokens = tokenizer(content, return_tensors="pt", padding=True, truncation=True, max_length=chunk_size).input_ids
-        num_chunks = tokens.size(1) // chunk_size + (1 if tokens.size(1) % chunk_size > 0 else 0)
-
-        for i in range(num_chunks):
-            start_idx = max(i * chunk_size - overlap, 0)
-            end_idx = start_idx + chunk_size
-            chunk_tokens = tokens[:, start_idx:end_idx]
-
-            with torch.no_grad():
-                # Compute embedding for each chunk using [CLS] token pooling
-                chunk_embedding = model(chunk_tokens).last_hidden_state[:, 0, :].squeeze()
-                # Normalize each chunk embedding
-                chunk_embedding = F.normalize(chunk_embedding, p=2, dim=0)
-                embeddings.append(chunk_embedding)
-
-    # Combine embeddings using max pooling (alternative to averaging)
-    final_embedding = torch.stack(embeddings).max(dim=0)[0]
-    # Normalize the final combined embedding
-    final_embedding = F.normalize(final_embedding, p=2, dim=0).tolist()
-
-    print(f"Generated embedding shape for {requestType}: {len(final_embedding)}")
-    return final_embedding
-
-def on_message(channel, method, properties, body):
-    message = json.loads(body)
-    print(f"Received a message with requestId: {message.get('requestId')} and type: {message.get('type')} and length: {len(message.get('content'))}")
-
-    content = message.get("content")
-    requestType = message.get("type")
-    if requestType != "code" and requestType != "query":
-        print("Invalid request type")
-        return
+        # Split code content into overlapping chunks of max CODE_CHUNK_SIZE tokens
+        max_length, overlap, max_chunks = CODE_CHUNK_SIZE, CODE_CHUNK_OVERLAP, MAX_CHUNKS_PER_REQUEST
+    body_length = max_length - tokenizer.num_special_tokens_to_add()
+    max_tokens = body_length + (max_chunks - 1) * (body_length - overlap)
 
-    startTime = time.time()
-    embedding = generate_embedding(content, requestType)
-    durationInMs = round((time.time() - startTime) * 1000, 2)
-    result = {
-        "requestId": message.get("requestId"),
-        "embedding": embedding
-    }
-
-    channel.basic_publish(
-        exchange=RABBITMQ_RESPONSES_EXCHANGE,
-        routing_key=requestType,
-        body=json.dumps(result)
+    windows = []
+    chunk_counts = []
+    with STAGE_SECONDS.time(stage="tokenize", type=requestType):
+        # Tokenize every input once, only cutting the tokens beyond the chunk limit
+        encoded = tokenizer(contents, add_special_tokens=False, truncation=True, max_length=max_tokens)["input_ids"]
+
+        for token_ids in encoded:
+            if max_chunks > 1 and len(token_ids) == max_tokens:
+                log("chunk_limit", f"Content reached the limit of {max_chunks} chunks per request, the rest is ignored", level="warning", type=requestType)
+            input_windows = build_windows(token_ids, body_length, overlap)
+            windows.extend(input_windows)
+            chunk_counts.append(len(input_windows))
+            CHUNKS_PER_REQUEST.observe(len(input_windows), type=requestType)
+
+    return windows, chunk_counts
+
+def embed_tokenized(windows, chunk_counts, requestType):
+    window_embeddings, padding = embed_windows(windows, requestType)
+
+    embeddings = []
+    with STAGE_SECONDS.time(stage="pool", type=requestType):
+        for chunk_embeddings in torch.split(window_embeddings, chunk_counts):
+            # Combine the chunk embeddings of an input using max pooling (alternative to averaging)
+            final_embedding = chunk_embeddings.max(dim=0)[0]
+            # Normalize the final combined embedding
+            embeddings.append(F.normalize(final_embedding, p=2, dim=0).tolist())
+
+    paddingEfficiency = padding["tokens"] / padding["padded_tokens"] * 100
+    log(
+        "embeddings_generated",
+        f"Generated {len(embeddings)} embeddings for {requestType} from {len(windows)} chunks in {padding['batches']} forward passes, padding efficiency: {round(paddingEfficiency, 1)}%",
+        type=requestType, embeddings=len(embeddings), chunks=len(windows), forward_passes=padding["batches"], padding_efficiency=round(paddingEfficiency, 1)
     )
+    return embeddings
+
+def generate_embeddings(contents, requestType):
+    windows, chunk_counts = tokenize_contents(contents, requestType)
+    return embed_tokenized(windows, chunk_counts, requestType)
+
+def generate_embedding(content, requestType):
+    return generate_embeddings([content], requestType)[0]
+
+def generate_embeddings_cached(contents, requestType):
+    if embedding_cache is None:
+        return generate_embeddings(contents, requestType)
+    return embedding_cache.get_or_compute(requestType, contents, lambda missing: generate_embeddings(missing, requestType))
+
+class CodeBertModel:
+    # The CodeBERT pipeline of this module in the model registry: [CLS] pooling of every chunk,
+    # max-pooled over the chunks. Pinned, the supervisor loads it before forking the workers
+    def load(self):
+        load_model()
+        self.dimension = backend.hidden_size
+
+    def unload(self):
+        pass
+
+    def memory_bytes(self):
+        if hasattr(backend, "model"):
+            return sum(parameter.numel() * parameter.element_size() for parameter in backend.model.parameters())
+        return path.getsize(backend.model_path)
+
+    def embed(self, contents, requestType):
+        return generate_embeddings_cached(contents, requestType)
+
+def build_registry():
+    registry = ModelRegistry(DEFAULT_MODEL, int(MODEL_MEMORY_MB * 1024 * 1024), MODEL_IDLE_S)
+    registry.register("codebert", CodeBertModel(), "{type}", pinned=True)
+    if "sbert" in EMBEDIFY_MODELS:
+        # Memory tier only, the disk tier of EMBEDDING_CACHE_PATH holds one fingerprint
+        cache = EmbeddingCache(f"{SBERT_MODEL_NAME}|mean|{SBERT_MAX_LENGTH}", int(EMBEDDING_CACHE_MAX_MB * 1024 * 1024)) if EMBEDDING_CACHE_MAX_MB > 0 else None
+        registry.register("sbert", MeanPoolingModel(SBERT_MODEL_NAME, SBERT_MODEL_PATH, SBERT_MAX_LENGTH, MAX_INFERENCE_BATCH, cache), "sbert.{type}")
+    return registry
+
+registry = build_registry()
+Gauge("embedify_model_memory_bytes", "Memory of the loaded models", ("model",), collect=registry.memory)
 
-    print(f"Input embedified in {durationInMs} ms, published the embedding to the {RABBITMQ_RESPONSES_EXCHANGE} exchange with the routing key: {requestType}")
+def parse_deliveries(deliveries, batchStartTime):
+    # Group the valid messages by model and request type, each group is embedded in one
+    # forward pass, and return the deliveries to reject with the queue wait of every message
+    requests = {}
+    rejected = []
+    queueWaits = []
+    BATCH_SIZE.observe(len(deliveries))
+    for method, properties, body, receivedAt in deliveries:
+        queueWaits.append((batchStartTime - receivedAt) * 1000)
+        try:
+            message = json.loads(body)
+        except ValueError:
+            log("message_rejected", f"Rejected a message that is not valid JSON, delivery tag: {method.delivery_tag}", level="warning", reason="json")
+            rejected.append(method)
+            MESSAGES.inc(type="unknown", outcome="rejected")
+            continue
 
-    channel.basic_ack(delivery_tag=method.delivery_tag)
+        requestType = message.get("type") if isinstance(message, dict) else None
+        content = message.get("content") if isinstance(message, dict) else None
+        if requestType not in LANES or not isinstance(content, str):
+            requestId = message.get("requestId") if isinstance(message, dict) else None
+            log("message_rejected", f"Invalid request type, rejected the message with requestId: {requestId}", level="warning", reason="type", requestId=requestId)
+            rejected.append(method)
+            MESSAGES.inc(type="unknown", outcome="rejected")
+            continue
+
+        # The response encoding is picked per request, or per producer with a message header
+        encoding = message.get("encoding") or (properties.headers or {}).get("embedding-encoding") or "json"
+        if encoding not in RESPONSE_ENCODINGS:
+            log("message_rejected", f"Invalid response encoding: {encoding}, rejected the message with requestId: {message.get('requestId')}", level="warning", reason="encoding", requestId=message.get("requestId"))
+            rejected.append(method)
+            MESSAGES.inc(type=requestType, outcome="rejected")
+            continue
+
+        modelName = message.get("model") or DEFAULT_MODEL
+        if modelName not in registry.models:
+            log("message_rejected", f"Unknown model: {modelName}, rejected the message with requestId: {message.get('requestId')}", level="warning", reason="model", requestId=message.get("requestId"))
+            rejected.append(method)
+            MESSAGES.inc(type=requestType, outcome="rejected")
+            continue
+
+        log("message_received", f"Received a message with requestId: {message.get('requestId')} and type: {requestType} and length: {len(content)}", level="debug", requestId=message.get("requestId"), type=requestType, length=len(content))
+        QUEUE_WAIT_SECONDS.observe(batchStartTime - receivedAt, type=requestType)
+        requests.setdefault((modelName, requestType), []).append((method, message, encoding))
+
+    return requests, rejected, queueWaits
+
+def embed_requests(requests):
+    # Embed and serialize every group, returns the responses to publish as (type, routing key,
+    # method, body, content type, headers) and the failed groups as (type, methods)
+    responses = []
+    failed = []
+    for (modelName, requestType), group in requests.items():
+        try:
+            embeddings = registry.embed(modelName, [message.get("content") for _, message, _ in group], requestType)
+        except Exception as error:
+            log("embedding_failed", f"Failed to embedify {len(group)} {modelName} {requestType} messages: {error}", level="error", model=modelName, type=requestType, messages=len(group), error=str(error))
+            failed.append((requestType, [method for method, _, _ in group]))
+            continue
+
+        routingKey = registry.routing_key(modelName, requestType)
+        for (method, message, encoding), embedding in zip(group, embeddings):
+            with STAGE_SECONDS.time(stage="serialize", type=requestType):
+                body, contentType, headers = encode_embedding(message.get("requestId"), embedding, encoding)
+            headers["model"] = modelName
+            responses.append((requestType, routingKey, method, body, contentType, headers))
+
+    return responses, failed
+
+def log_batch(deliveries, requests, batchStartTime, queueWaits):
+    durationInMs = round((time.time() - batchStartTime) * 1000, 2)
+    batch_stats["batches"] += 1
+    batch_stats["messages"] += len(deliveries)
+    averageBatchSize = batch_stats["messages"] / batch_stats["batches"]
+    counts = {lane: sum(len(group) for (_, requestType), group in requests.items() if requestType == lane) for lane in LANES}
+    log(
+        "batch_processed",
+        f"Embedified a batch of {len(deliveries)} messages (code: {counts['code']}, query: {counts['query']}) in {durationInMs} ms, "
+        f"queue wait avg: {round(sum(queueWaits) / len(queueWaits), 2)} ms, max: {round(max(queueWaits), 2)} ms, "
+        f"effective batch size avg: {round(averageBatchSize, 2)}",
+        messages=len(deliveries), code=counts["code"], query=counts["query"], duration_ms=durationInMs,
+        queue_wait_avg_ms=round(sum(queueWaits) / len(queueWaits), 2), queue_wait_max_ms=round(max(queueWaits), 2)
+    )
+    if embedding_cache is not None:
+        log("embedding_cache", f"Embedding cache: {embedding_cache.counters()}", level="debug", **embedding_cache.counters())
+
+def request_lane(body):
+    # Lane of a message of the legacy queue, invalid messages are rejected from the code lane
+    try:
+        message = json.loads(body)
+    except ValueError:
+        return "code"
+    return "query" if isinstance(message, dict) and message.get("type") == "query" else "code"
+
+def compute_batch(deliveries):
+    # Everything of a batch that does not touch the channel, run on the inference thread
+    batchStartTime = time.time()
+    requests, rejected, queueWaits = parse_deliveries(deliveries, batchStartTime)
+    responses, failed = embed_requests(requests)
+    return batchStartTime, requests, rejected, queueWaits, responses, failed
+
+class Consumer:
+    # Consumes the requests on a SelectConnection. The I/O loop buffers deliveries into batches
+    # and publishes the responses, while a single inference thread embeds one batch at a time,
+    # so heartbeats are answered during long forward passes and the next batch fills up in the
+    # meantime. Deliveries are buffered per lane and the next batch is taken from the query
+    # lane first (see CODE_LANE_SHARE). Responses are published in confirm mode and a request is
+    # acked only once the broker confirmed its response; the confirms arrive asynchronously,
+    # often several at once. A lost connection is reopened with an exponential backoff, the
+    # broker redelivers the requests that were not acked.
+    def __init__(self, on_ready=None):
+        self.on_ready = on_ready
+        self.ioloop = IOLoop()
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="inference")
+        self.connection = None
+        self.channel = None
+        # Consumer tag -> lane of its queue, None for the legacy queue
+        self.consumer_tags = {}
+        self.lanes = {lane: [] for lane in LANES}
+        # Recent inference time per lane, decayed after every batch
+        self.lane_seconds = {lane: 0.0 for lane in LANES}
+        self.batch_timer = None
+        self.inference = None
+        # Bumped on every new channel, results of a batch from a previous channel are dropped
+        self.generation = 0
+        # Publish sequence number -> (request delivery tag, request type, received at, lane) until confirmed
+        self.publish_sequence = 0
+        self.unconfirmed = {}
+        self.reconnect_delay = RECONNECT_DELAY
+        self.connected_once = False
+        self.stopping = False
+        self.stop_deadline = None
+
+    def run(self):
+        self.connect()
+        self.ioloop.call_later(0.2, self.check_stop)
+        self.ioloop.start()
+        self.executor.shutdown(wait=True)
+
+    def connect(self):
+        self.connectStartTime = time.time()
+        self.connection = pika.SelectConnection(
+            connection_parameters(),
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_error,
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=self.ioloop
+        )
+
+    def reconnect(self):
+        if self.stopping:
+            self.ioloop.stop()
+            return
+        # Exponential backoff with jitter, so that restarted brokers are not hit by every worker at once
+        delay = self.reconnect_delay * random.uniform(0.5, 1)
+        self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX_DELAY)
+        log("reconnecting", f"Reconnecting to RabbitMQ in {round(delay, 2)} s", level="warning", delay_s=round(delay, 2))
+        RECONNECTS.inc()
+        self.ioloop.call_later(delay, self.connect)
+
+    def on_connection_error(self, connection, error):
+        log("connection_failed", f"Could not connect to RabbitMQ: {error}", level="warning", error=str(error))
+        self.reconnect()
+
+    def on_connection_closed(self, connection, reason):
+        self.channel = None
+        self.consumer_tags = {}
+        self.reset()
+        if not self.stopping:
+            log("connection_lost", f"Lost the connection to RabbitMQ: {reason}", level="warning", reason=str(reason))
+        self.reconnect()
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+        self.generation += 1
+        self.publish_sequence = 0
+        channel.add_on_close_callback(self.on_channel_closed)
+        self.declare(topology())
+
+    def on_channel_closed(self, channel, reason):
+        # A channel closed by the broker (e.g. a declaration mismatch) takes the connection along,
+        # which is then reopened
+        if channel is self.channel and self.connection.is_open:
+            log("channel_closed", f"The RabbitMQ channel was closed: {reason}", level="warning", reason=str(reason))
+            self.connection.close()
+
+    def declare(self, steps):
+        if steps:
+            method, arguments = steps[0]
+            getattr(self.channel, method)(callback=lambda frame: self.declare(steps[1:]), **arguments)
+            return
+        self.channel.confirm_delivery(self.on_confirm, callback=lambda frame: self.channel.basic_qos(prefetch_count=BATCH_PREFETCH, callback=self.on_qos))
+
+    def on_qos(self, frame):
+        # The prefetch count applies to every consumer, so bulk code requests never fill the
+        # buffer of the query lane
+        self.consumer_tags = {}
+        for queue, lane in ((RABBITMQ_QUERY_REQUESTS_QUEUE, "query"), (RABBITMQ_CODE_REQUESTS_QUEUE, "code"), (RABBITMQ_REQUESTS_QUEUE, None)):
+            self.consumer_tags[self.channel.basic_consume(queue, self.on_message)] = lane
+        self.reconnect_delay = RECONNECT_DELAY
+        if not self.connected_once:
+            self.connected_once = True
+            startup_timings["connect"] = round(time.time() - self.connectStartTime, 3)
+            if QUEUE_DEPTH_INTERVAL > 0:
+                self.ioloop.call_later(QUEUE_DEPTH_INTERVAL, self.poll_queue_depths)
+            if self.on_ready is not None:
+                self.on_ready()
+        else:
+            readiness["ready"] = True
+            log("reconnected", "Reconnected to RabbitMQ, consuming again")
+
+    def reset(self):
+        # The broker requeues everything that was not acked, forget it here
+        readiness["ready"] = False
+        if self.batch_timer is not None:
+            self.ioloop.remove_timeout(self.batch_timer)
+            self.batch_timer = None
+        for lane in LANES:
+            self.lanes[lane] = []
+            LANE_BUFFERED.set(0, lane=lane)
+        self.unconfirmed = {}
+        IN_FLIGHT.set(0)
+
+    def poll_queue_depths(self):
+        if self.stopping:
+            return
+        if self.channel is not None and self.channel.is_open:
+            for queue in (RABBITMQ_QUERY_REQUESTS_QUEUE, RABBITMQ_CODE_REQUESTS_QUEUE, RABBITMQ_REQUESTS_QUEUE):
+                self.channel.queue_declare(queue, passive=True, callback=lambda frame, queue=queue: QUEUE_DEPTH.set(frame.method.message_count, queue=queue))
+        self.ioloop.call_later(QUEUE_DEPTH_INTERVAL, self.poll_queue_depths)
+
+    def on_message(self, channel, method, properties, body):
+        lane = self.consumer_tags.get(method.consumer_tag) or request_lane(body)
+        self.lanes[lane].append((method, properties, body, time.time()))
+        LANE_BUFFERED.set(len(self.lanes[lane]), lane=lane)
+        IN_FLIGHT.inc()
+        self.schedule()
+
+    def on_batch_window(self):
+        self.batch_timer = None
+        self.schedule()
+
+    def schedule(self):
+        # Start the next batch when the inference thread is idle and a lane is full or its oldest
+        # delivery waited for the batching window, otherwise wake up when the window is over
+        if self.inference is not None:
+            return
+        if self.batch_timer is not None:
+            self.ioloop.remove_timeout(self.batch_timer)
+            self.batch_timer = None
+
+        now = time.time()
+        window = BATCH_WINDOW_MS / 1000
+        ready = [lane for lane in LANES if self.lanes[lane] and (len(self.lanes[lane]) >= BATCH_MAX_SIZE or now - self.lanes[lane][0][3] >= window or self.stopping)]
+        if ready:
+            self.dispatch(self.pick_lane(ready))
+            return
+
+        oldest = [self.lanes[lane][0][3] for lane in LANES if self.lanes[lane]]
+        if oldest:
+            self.batch_timer = self.ioloop.call_later(max(0, min(oldest) + window - now), self.on_batch_window)
+
+    def pick_lane(self, ready):
+        if len(ready) == 1:
+            return ready[0]
+        # Both lanes have a batch: queries go first unless code got less than its share lately
+        total = sum(self.lane_seconds.values())
+        if total > 0 and self.lane_seconds["code"] / total < CODE_LANE_SHARE:
+            return "code"
+        return "query"
+
+    def dispatch(self, lane):
+        deliveries = self.lanes[lane][:BATCH_MAX_SIZE]
+        self.lanes[lane] = self.lanes[lane][BATCH_MAX_SIZE:]
+        LANE_BUFFERED.set(len(self.lanes[lane]), lane=lane)
+        generation = self.generation
+        dispatchTime = time.time()
+        self.inference = self.executor.submit(compute_batch, deliveries)
+        self.inference.add_done_callback(lambda future: self.ioloop.add_callback_threadsafe(lambda: self.on_batch_done(generation, lane, deliveries, dispatchTime, future)))
+
+    def on_batch_done(self, generation, lane, deliveries, dispatchTime, future):
+        self.inference = None
+        duration = time.time() - dispatchTime
+        for name in LANES:
+            self.lane_seconds[name] *= LANE_SHARE_DECAY
+        self.lane_seconds[lane] += duration
+        LANE_BATCHES.inc(lane=lane)
+        LANE_INFERENCE_SECONDS.inc(duration, lane=lane)
+
+        if generation != self.generation or self.channel is None or not self.channel.is_open:
+            log("batch_dropped", f"Dropped the results of {len(deliveries)} messages from a closed channel, the broker redelivers them", level="warning", messages=len(deliveries))
+        else:
+            self.publish_batch(lane, deliveries, future)
+        self.schedule()
+
+    def publish_batch(self, lane, deliveries, future):
+        try:
+            batchStartTime, requests, rejected, queueWaits, responses, failed = future.result()
+        except Exception as error:
+            # Not a failure of the model, which embed_requests handles per group
+            log("batch_failed", f"Failed to process a batch of {len(deliveries)} messages: {error}", level="error", error=str(error))
+            for delivery in deliveries:
+                self.settle_failed(lane, delivery)
+            return
+
+        # Poison messages go to the dead-letter exchange
+        for method in rejected:
+            self.channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            IN_FLIGHT.dec()
+
+        delivered = {delivery[0].delivery_tag: delivery for delivery in deliveries}
+        for requestType, methods in failed:
+            for method in methods:
+                self.settle_failed(lane, delivered[method.delivery_tag], requestType)
+
+        for requestType, routingKey, method, body, contentType, headers in responses:
+            with STAGE_SECONDS.time(stage="publish", type=requestType):
+                self.channel.basic_publish(
+                    exchange=RABBITMQ_RESPONSES_EXCHANGE,
+                    routing_key=routingKey,
+                    body=body,
+                    properties=pika.BasicProperties(content_type=contentType, headers=headers)
+                )
+            self.publish_sequence += 1
+            self.unconfirmed[self.publish_sequence] = (method.delivery_tag, requestType, delivered[method.delivery_tag][3], lane, "ok")
+
+        log_batch(deliveries, requests, batchStartTime, queueWaits)
+
+    def settle_failed(self, lane, delivery, requestType="unknown"):
+        # The failed request is published again with one more attempt in its headers and acked
+        # once the broker confirmed the copy; the redelivered flag cannot count the failures,
+        # it is also set on the requests redelivered after a lost connection
+        method, properties, body, receivedAt = delivery
+        headers = dict(properties.headers or {})
+        attempts = int(headers.get(REQUEST_ATTEMPTS_HEADER, 0)) + 1
+        if attempts >= REQUEST_MAX_ATTEMPTS:
+            self.channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            MESSAGES.inc(type=requestType, outcome="failed")
+            IN_FLIGHT.dec()
+            return
+
+        headers[REQUEST_ATTEMPTS_HEADER] = attempts
+        properties.headers = headers
+        self.channel.basic_publish(exchange=method.exchange, routing_key=method.routing_key, body=body, properties=properties)
+        self.publish_sequence += 1
+        self.unconfirmed[self.publish_sequence] = (method.delivery_tag, requestType, receivedAt, lane, "retried")
+
+    def on_confirm(self, frame):
+        # The broker confirms one publish, or with multiple every publish up to delivery_tag
+        confirmation = frame.method
+        acked = isinstance(confirmation, pika.spec.Basic.Ack)
+        CONFIRMS.inc(result="ack" if acked else "nack")
+        if confirmation.multiple:
+            sequences = [sequence for sequence in self.unconfirmed if sequence <= confirmation.delivery_tag]
+        else:
+            sequences = [confirmation.delivery_tag]
+
+        for sequence in sequences:
+            if sequence not in self.unconfirmed:
+                continue
+            requestTag, requestType, receivedAt, lane, outcome = self.unconfirmed.pop(sequence)
+            if acked:
+                # The request is answered, or its retry is queued
+                self.channel.basic_ack(delivery_tag=requestTag)
+                MESSAGES.inc(type=requestType, outcome=outcome)
+                if outcome == "ok":
+                    REQUEST_SECONDS.observe(time.time() - receivedAt, lane=lane)
+            else:
+                # The response or the retry was lost by the broker, the request is embedded again
+                self.channel.basic_nack(delivery_tag=requestTag, requeue=True)
+                MESSAGES.inc(type=requestType, outcome="requeued")
+            IN_FLIGHT.dec()
+
+    def check_stop(self):
+        if stop_consuming.is_set() and not self.stopping:
+            self.stopping = True
+            self.stop_deadline = time.time() + CONFIRM_TIMEOUT
+            if self.channel is not None and self.channel.is_open:
+                for consumer_tag in self.consumer_tags:
+                    self.channel.basic_cancel(consumer_tag)
+
+        if self.stopping:
+            if self.connection is None or not self.connection.is_open:
+                # Not connected, nothing is left to settle
+                self.ioloop.stop()
+                return
+            # Finish the buffered deliveries and wait for their confirms, then close; whatever
+            # is left unacked at the deadline is requeued by the broker
+            self.schedule()
+            buffered = any(self.lanes[lane] for lane in LANES)
+            drained = self.inference is None and not buffered and not self.unconfirmed
+            if drained or time.time() >= self.stop_deadline:
+                self.connection.close()
+                return
+
+        self.ioloop.call_later(0.1 if self.stopping else 0.2, self.check_stop)
+
+def request_shutdown(signum, frame):
+    log("shutdown_requested", f"Received signal {signum} in process {getpid()}, shutting down after the current batch...", signal=signum)
+    stop_consuming.set()
+
+def run_worker(threads, slot=None):
+    workerStartTime = time.time()
+    metricsPort = METRICS_PORT + (slot or 0) if METRICS_PORT else None
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    # `kill -USR1 <pid>` starts the sampling profiler, a second one stops it and writes the stacks
+    signal.signal(signal.SIGUSR1, profiler.toggle)
+    # The probe answers 503 from here until the worker consumes
+    if metricsPort:
+        start_metrics_server(metricsPort)
+
+    load_model()
+    if threads:
+        torch.set_num_threads(threads)
+    if WARMUP:
+        warm_up()
+
+    def on_ready():
+        mark_ready(workerStartTime, slot)
+        log(
+            "worker_started",
+            f"Embedify worker {getpid()} started with {torch.get_num_threads()} threads, batch size: {BATCH_MAX_SIZE}, batch window: {BATCH_WINDOW_MS} ms, prefetch: {BATCH_PREFETCH}, "
+            f"metrics port: {metricsPort or 'disabled'}, ready in {startup_timings['ready']} s, waiting for messages...",
+            threads=torch.get_num_threads(), metrics_port=metricsPort, **startup_timings
+        )
+
+    try:
+        Consumer(on_ready).run()
+    finally:
+        readiness["ready"] = False
+        if READINESS_FILE and slot is not None:
+            remove_readiness(readiness_path(slot))
+    log("worker_stopped", f"Embedify worker {getpid()} stopped")
+
+def supervise(workers, threads):
+    # Forked workers share the model weights loaded by the supervisor copy-on-write,
+    # platforms without fork load the model again in every worker
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    processes = {}
+
+    def start_worker(slot):
+        # The file of a worker that was killed does not announce the new one
+        if READINESS_FILE:
+            remove_readiness(readiness_path(slot))
+        process = context.Process(target=run_worker, args=(threads, slot), name=f"embedify-worker-{slot}")
+        process.start()
+        processes[slot] = process
+
+    def forward_to_workers(signum, frame):
+        for process in processes.values():
+            if process.is_alive():
+                kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGUSR1, forward_to_workers)
+
+    def update_readiness():
+        # READINESS_FILE lists the workers while every one of them consumes
+        slots = [readiness_path(slot) for slot in processes]
+        if all(path.exists(slotPath) for slotPath in slots):
+            if path.exists(READINESS_FILE):
+                return
+            statuses = []
+            for slotPath in slots:
+                try:
+                    with open(slotPath) as file:
+                        statuses.append(json.load(file))
+                except FileNotFoundError:
+                    # The worker stopped in the meantime
+                    remove_readiness(READINESS_FILE)
+                    return
+            write_readiness(READINESS_FILE, {"ready": True, "pid": getpid(), "workers": statuses})
+        else:
+            remove_readiness(READINESS_FILE)
+
+    for slot in range(workers):
+        start_worker(slot)
+    log("supervisor_started", f"Embedify supervisor {getpid()} started {workers} workers with {threads} threads each", workers=workers, threads=threads)
+
+    # Restart the workers that exit until the supervisor is asked to shut down
+    while not stop_consuming.is_set():
+        wait([process.sentinel for process in processes.values()], timeout=1)
+        for slot, process in list(processes.items()):
+            if not process.is_alive() and not stop_consuming.is_set():
+                log("worker_exited", f"Worker {process.pid} exited with code {process.exitcode}, restarting it...", level="warning", worker=process.pid, exit_code=process.exitcode)
+                if READINESS_FILE:
+                    remove_readiness(readiness_path(slot))
+                time.sleep(WORKER_RESTART_DELAY)
+                start_worker(slot)
+        if READINESS_FILE:
+            update_readiness()
+
+    # The pool stops consuming
+    if READINESS_FILE:
+        remove_readiness(READINESS_FILE)
+
+    # Ask every worker to finish its current batch, and kill the ones that take too long
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.time() + WORKER_SHUTDOWN_TIMEOUT
+    for process in processes.values():
+        process.join(max(0, deadline - time.time()))
+        if process.is_alive():
+            log("worker_killed", f"Worker {process.pid} did not stop in time, killing it", level="warning", worker=process.pid)
+            process.kill()
+    if READINESS_FILE:
+        for slot in processes:
+            remove_readiness(readiness_path(slot))
+    log("supervisor_stopped", "Embedify supervisor stopped")
 
 def main():
-    channel = connect_to_rabbitmq()
-    print("Embedify started, waiting for messages...")
-    channel.basic_consume(queue=RABBITMQ_REQUESTS_QUEUE, on_message_callback=on_message)
-    channel.start_consuming()
+    parser = argparse.ArgumentParser(description="Embedify embedding worker")
+    parser.add_argument("--workers", type=int, default=EMBEDIFY_WORKERS, help="number of consumer processes")
+    args = parser.parse_args()
+
+    # A readiness file left behind by a previous run must not announce this one
+    if READINESS_FILE:
+        remove_readiness(READINESS_FILE)
+
+    threads = int(TORCH_THREADS) if TORCH_THREADS else None
+    try:
+        if args.workers > 1:
+            load_model()
+            # Keep workers × threads within the number of cores
+            supervise(args.workers, threads or max(1, (cpu_count() or 1) // args.workers))
+        else:
+            run_worker(threads)
+    finally:
+        if READINESS_FILE:
+            remove_readiness(READINESS_FILE)
 
 if __name__ == "__main__":
     main()
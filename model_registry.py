@@ -0,0 +1,127 @@
+# Registry of the embedding models a worker serves. A request names its model in its `model`
+# field, and every model brings its own tokenizer, pooling, dimension and response routing key.
+# Models are loaded on their first request; when the loaded models exceed the memory budget,
+# or a model stayed idle for too long, the least recently used ones are unloaded. Pinned models
+# (the default one, shared by the forked workers) are never unloaded.
+
+import gc
+import time
+from telemetry import Counter, log
+
+MODEL_EVENTS = Counter("embedify_model_events_total", "Models loaded and unloaded by the registry", ("model", "event"))
+
+class MeanPoolingModel:
+    # Sentence-transformers style model: the token embeddings averaged over the attention mask
+    # and L2-normalized, as SentenceTransformer("all-MiniLM-L6-v2").encode computes them
+    def __init__(self, model_name, model_path=None, max_length=256, batch_size=32, cache=None):
+        self.model_name = model_name
+        self.model_path = model_path
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.cache = cache
+        self.tokenizer = None
+        self.model = None
+        self.dimension = None
+
+    def load(self):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        source = self.model_path or self.model_name
+        options = {"local_files_only": True} if self.model_path else {}
+        self.tokenizer = AutoTokenizer.from_pretrained(source, **options)
+        self.model = AutoModel.from_pretrained(source, **options).eval()
+        self.dimension = self.model.config.hidden_size
+
+    def unload(self):
+        self.tokenizer = None
+        self.model = None
+
+    def memory_bytes(self):
+        return sum(parameter.numel() * parameter.element_size() for parameter in self.model.parameters())
+
+    def embed(self, contents, requestType):
+        if self.cache is None:
+            return self.encode(contents)
+        return self.cache.get_or_compute(requestType, contents, self.encode)
+
+    def encode(self, contents):
+        import torch
+        import torch.nn.functional as F
+
+        # Contents of similar lengths share a batch, so little of it is padding
+        order = sorted(range(len(contents)), key=lambda index: len(contents[index]))
+        embeddings = [None] * len(contents)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            batch = self.tokenizer([contents[index] for index in indices], padding=True, truncation=True, max_length=self.max_length, return_tensors="pt")
+            with torch.no_grad():
+                hidden_states = self.model(**batch).last_hidden_state
+            mask = batch["attention_mask"].unsqueeze(-1).to(hidden_states.dtype)
+            pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            for index, embedding in zip(indices, F.normalize(pooled, p=2, dim=1).tolist()):
+                embeddings[index] = embedding
+        return embeddings
+
+class ModelRegistry:
+    def __init__(self, default, memory_budget_bytes=0, idle_seconds=0):
+        self.default = default
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_seconds = idle_seconds
+        # name -> {"model", "routing_key", "pinned", "loaded", "bytes", "last_used"}
+        self.models = {}
+
+    def register(self, name, model, routing_key, pinned=False):
+        # routing_key is formatted with the request type, e.g. "{type}" or "sbert.{type}"
+        self.models[name] = {"model": model, "routing_key": routing_key, "pinned": pinned, "loaded": False, "bytes": 0, "last_used": 0}
+
+    def routing_key(self, name, requestType):
+        return self.models[name]["routing_key"].format(type=requestType)
+
+    def memory(self):
+        return {name: entry["bytes"] for name, entry in self.models.items() if entry["loaded"]}
+
+    def embed(self, name, contents, requestType):
+        entry = self.get(name)
+        entry["last_used"] = time.time()
+        return entry["model"].embed(contents, requestType)
+
+    def get(self, name):
+        entry = self.models[name]
+        self.unload_idle(keep=name)
+        if not entry["loaded"]:
+            startTime = time.time()
+            entry["model"].load()
+            entry["loaded"] = True
+            entry["bytes"] = entry["model"].memory_bytes()
+            MODEL_EVENTS.inc(model=name, event="load")
+            log("model_loaded", f"Loaded the {name} model ({round(entry['bytes'] / 1024 / 1024)} MB) in {round(time.time() - startTime, 2)} s", model=name, bytes=entry["bytes"])
+            self.enforce_budget(keep=name)
+        return entry
+
+    def unload_idle(self, keep):
+        if not self.idle_seconds:
+            return
+        for name, entry in self.models.items():
+            if name != keep and entry["loaded"] and not entry["pinned"] and time.time() - entry["last_used"] > self.idle_seconds:
+                self.unload(name, "idle")
+
+    def enforce_budget(self, keep):
+        if not self.memory_budget_bytes:
+            return
+        # Least recently used first
+        candidates = sorted((entry["last_used"], name) for name, entry in self.models.items() if name != keep and entry["loaded"] and not entry["pinned"])
+        for _, name in candidates:
+            if sum(self.memory().values()) <= self.memory_budget_bytes:
+                return
+            self.unload(name, "budget")
+        if sum(self.memory().values()) > self.memory_budget_bytes:
+            log("model_budget_exceeded", f"The loaded models use {round(sum(self.memory().values()) / 1024 / 1024)} MB, above the budget of {round(self.memory_budget_bytes / 1024 / 1024)} MB", level="warning")
+
+    def unload(self, name, reason):
+        entry = self.models[name]
+        entry["model"].unload()
+        entry["loaded"] = False
+        entry["bytes"] = 0
+        gc.collect()
+        MODEL_EVENTS.inc(model=name, event="unload")
+        log("model_unloaded", f"Unloaded the {name} model ({reason})", model=name, reason=reason)
@@ -0,0 +1,26 @@
+from os import listdir, path, stat
+import hashlib
+import json
+
+# Identity of the weights that compute the embeddings, without importing torch: main.py puts it
+# in the embedding cache fingerprint and inference_backend.py in the path of the ONNX graphs, so
+# a new revision or snapshot neither serves cached embeddings nor loads a graph exported from
+# the previous weights.
+
+def model_identity(model_path=None, revision=None):
+    # The commit recorded by download-codebert.py in a snapshot, or the names, sizes and
+    # modification times of the files of a snapshot saved otherwise, or the hub revision
+    # (unpinned when it is not set)
+    if not model_path:
+        return f"revision={revision or 'latest'}"
+    manifest = path.join(model_path, "snapshot.json")
+    if path.exists(manifest):
+        with open(manifest) as file:
+            snapshot = json.load(file)
+        if snapshot.get("commit"):
+            return f"commit={snapshot['commit']}"
+    files = hashlib.sha256()
+    for name in sorted(listdir(model_path)):
+        status = stat(path.join(model_path, name))
+        files.update(f"{name}\0{status.st_size}\0{status.st_mtime_ns}\0".encode("utf-8"))
+    return f"files={files.hexdigest()[:16]}"
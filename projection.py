@@ -0,0 +1,108 @@
+# Optional dimensionality reduction of the stored embeddings, enabled with PROJECTION_DIM:
+# PCA is fitted on a sample of PROJECTION_SAMPLE embeddings of a collection, and the mean and
+# the components are saved to PROJECTION_DIR/<collection>.npz. The same projection is applied
+# to the indexed vectors and to the queries, which are L2-normalized again afterwards so inner
+# product and cosine scores keep their meaning.
+#
+# CodeBERT and all-MiniLM-L6-v2 were not trained with a Matryoshka loss, so truncating their
+# vectors to the first dimensions loses much more than projecting them on their principal
+# components. A projection can also be fitted from a .npy file of embeddings, e.g. the
+# vectors.npy of a collection of the local vector store:
+#   python projection.py vector-store/code_embeddings_py/vectors.npy --collection code_embeddings_py --dim 256
+
+from os import environ
+import argparse
+import hashlib
+import os
+import numpy as np
+
+PROJECTION_DIM = int(environ.get("PROJECTION_DIM", 0))
+PROJECTION_DIR = environ.get("PROJECTION_DIR", "projections")
+PROJECTION_SAMPLE = int(environ.get("PROJECTION_SAMPLE", 20000))
+
+class Projection:
+    def __init__(self, mean, components, explained_variance):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        # Fraction of the variance of the sample kept by the components
+        self.explained_variance = float(explained_variance)
+
+    @property
+    def dim(self):
+        return self.components.shape[0]
+
+    def fingerprint(self):
+        # Part of the incremental sync settings, a new projection re-embeds every snippet
+        return hashlib.sha256(self.components.tobytes()).hexdigest()[:16]
+
+    def apply(self, vectors):
+        projected = (np.atleast_2d(np.asarray(vectors, dtype=np.float32)) - self.mean) @ self.components.T
+        return projected / np.maximum(np.linalg.norm(projected, axis=1, keepdims=True), 1e-12)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # np.savez appends .npz to a name without it, write next to the final name and swap it in
+        with open(path + ".tmp", "wb") as file:
+            np.savez(file, mean=self.mean, components=self.components, explained_variance=self.explained_variance)
+        os.replace(path + ".tmp", path)
+
+def projection_path(collection):
+    return os.path.join(PROJECTION_DIR, f"{collection}.npz")
+
+def fit(vectors, dim, sample=PROJECTION_SAMPLE, seed=0):
+    # Sample before converting, so a memory-mapped file is only read for the sampled rows
+    vectors = np.asarray(vectors)
+    if len(vectors) > sample:
+        vectors = vectors[np.sort(np.random.default_rng(seed).choice(len(vectors), sample, replace=False))]
+    vectors = vectors.astype(np.float32)
+    if dim >= vectors.shape[1]:
+        raise ValueError(f"PROJECTION_DIM={dim} does not reduce {vectors.shape[1]}-dimensional embeddings")
+    if len(vectors) <= dim:
+        raise ValueError(f"Fitting a {dim}-dimensional projection needs more than {dim} embeddings, got {len(vectors)}")
+
+    mean = vectors.mean(axis=0)
+    # The right singular vectors of the centered sample are its principal components
+    _, singular_values, components = np.linalg.svd(vectors - mean, full_matrices=False)
+    variances = singular_values ** 2
+    return Projection(mean, components[:dim], variances[:dim].sum() / variances.sum())
+
+def load_projection(collection, dim=PROJECTION_DIM):
+    # None when the projection is disabled or was not fitted yet for this collection
+    path = projection_path(collection)
+    if not dim or not os.path.exists(path):
+        return None
+    with np.load(path) as file:
+        projection = Projection(file["mean"], file["components"], file["explained_variance"])
+    if projection.dim != dim:
+        raise ValueError(f"{path} projects to {projection.dim} dimensions, not PROJECTION_DIM={dim}; delete it to fit a new one")
+    return projection
+
+def fit_projection(collection, vectors, dim=PROJECTION_DIM):
+    # Fits the projection of the collection on a sample of vectors and saves it
+    projection = fit(vectors, dim)
+    projection.save(projection_path(collection))
+    print(f"Fitted a {projection.dim}-dimensional projection for '{collection}', keeping {round(projection.explained_variance * 100, 1)}% of the variance")
+    return projection
+
+def require_projection(collection, vectors=()):
+    # The projection of the collection when PROJECTION_DIM is set: the saved one, or one fitted
+    # on vectors when there are at least PROJECTION_SAMPLE of them. A projection fitted on a few
+    # snippets would not represent the corpus, so the examples need one fitted beforehand.
+    projection = load_projection(collection)
+    if not PROJECTION_DIM or projection is not None:
+        return projection
+    if len(vectors) >= PROJECTION_SAMPLE:
+        return fit_projection(collection, vectors)
+    raise ValueError(
+        f"PROJECTION_DIM={PROJECTION_DIM} needs a projection fitted on at least PROJECTION_SAMPLE={PROJECTION_SAMPLE} embeddings "
+        f"in {projection_path(collection)}, fit it first with projection.py or bulk-index.py"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the PCA projection of a collection on a .npy file of embeddings")
+    parser.add_argument("embeddings", help=".npy file of full-dimensional embeddings, one per row")
+    parser.add_argument("--collection", required=True, help="collection the projection is used for")
+    parser.add_argument("--dim", type=int, default=PROJECTION_DIM or 256, help="dimensions after the projection")
+    args = parser.parse_args()
+
+    fit_projection(args.collection, np.load(args.embeddings, mmap_mode="r"), args.dim)
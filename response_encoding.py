@@ -0,0 +1,41 @@
+import json
+import struct
+
+# Response encodings of an embedding: "json" keeps the original {"requestId", "embedding"}
+# body, the binary encodings publish the raw little-endian vector and describe it in the
+# AMQP properties (dtype and dim headers, plus the scale of int8 vectors)
+RESPONSE_ENCODINGS = ("json", "float32", "float16", "int8")
+
+def encode_embedding(requestId, embedding, encoding="json"):
+    if encoding == "json":
+        body = json.dumps({"requestId": requestId, "embedding": embedding})
+        return body, "application/json", {"requestId": requestId}
+
+    headers = {"requestId": requestId, "dtype": encoding, "dim": len(embedding)}
+    if encoding == "float32":
+        body = struct.pack(f"<{len(embedding)}f", *embedding)
+    elif encoding == "float16":
+        body = struct.pack(f"<{len(embedding)}e", *embedding)
+    elif encoding == "int8":
+        # Symmetric quantization, value = int8 * scale
+        scale = max((abs(value) for value in embedding), default=0.0) / 127 or 1.0
+        body = struct.pack(f"<{len(embedding)}b", *(round(value / scale) for value in embedding))
+        headers["scale"] = scale
+    else:
+        raise ValueError(f"Unknown response encoding: {encoding}")
+    return body, "application/octet-stream", headers
+
+def decode_embedding(body, headers):
+    dtype = (headers or {}).get("dtype")
+    if dtype is None:
+        return json.loads(body)["embedding"]
+
+    dim = headers["dim"]
+    if dtype == "float32":
+        return list(struct.unpack(f"<{dim}f", body))
+    if dtype == "float16":
+        return list(struct.unpack(f"<{dim}e", body))
+    if dtype == "int8":
+        scale = headers["scale"]
+        return [value * scale for value in struct.unpack(f"<{dim}b", body)]
+    raise ValueError(f"Unknown embedding dtype: {dtype}")
@@ -1,7 +1,19 @@
 from sentence_transformers import SentenceTransformer
-from pymilvus import connections, FieldSchema, CollectionSchema, DataType, Collection, utility
+from pymilvus import FieldSchema, CollectionSchema, DataType
+from incremental_sync import sync
+from projection import require_projection
+from vector_store import index_params, open_store, vector_field
+import argparse
+import os
 import numpy as np
 
+# Run with --incremental to only embed the added and modified sentences instead of
+# re-creating the collection
+parser = argparse.ArgumentParser()
+parser.add_argument("--incremental", action="store_true", help="sync the collection instead of re-creating it")
+parser.add_argument("--manifest", default="sentence_embeddings.manifest.json", help="manifest of the incremental sync")
+args = parser.parse_args()
+
 # 1. Load a pretrained Sentence Transformer model
 model = SentenceTransformer("F:\\SBERT-all-MiniLM-L6-v2")
 
@@ -29,42 +41,47 @@ sentences = [
     "Reviewed and merged pull requests to incorporate new features into the main codebase."
 ]
 
-# 2. Calculate embeddings
-embeddings = model.encode(sentences)
-
-# 3. Connect to Milvus
-connections.connect("default", host="localhost", port="19530")
-
-# 4. Create a collection in Milvus
+# 2. Create a collection in the vector store selected with VECTOR_STORE (Milvus by default,
+# see vector_store.py), the sentence is its own primary key. With PROJECTION_DIM set, the
+# embeddings are reduced by the PCA projection of the collection, fitted beforehand with
+# projection.py
 collection_name = "sentence_embeddings"
-if utility.has_collection(collection_name):
-    utility.drop_collection(collection_name)
-
+projection = require_projection(collection_name)
+dim = projection.dim if projection else model.get_sentence_embedding_dimension()
 fields = [
     FieldSchema(name="sentence", dtype=DataType.VARCHAR, max_length=500, is_primary=True),
-    FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=embeddings.shape[1])
+    vector_field(dim)
 ]
 schema = CollectionSchema(fields)
-collection = Collection(name=collection_name, schema=schema)
 
-# 5. Insert data into Milvus
-entities = [
-    sentences,
-    embeddings.tolist()
-]
-collection.insert(entities)
-collection.flush()
+# 3. Drop the existing collection unless it is synced incrementally, or when there is no
+# manifest of the rows it holds
+rebuild = not args.incremental or not os.path.exists(args.manifest)
+store, collection_exists = open_store(collection_name, schema, metric="COSINE", id_field="sentence", text_field="sentence", drop=rebuild, projection=projection)
 
-# 6. Create an index on the embedding field
-index_params = {
-    "index_type": "IVF_FLAT",
-    "metric_type": "COSINE",
-    "params": {"nlist": 100}
-}
-collection.create_index(field_name="embedding", index_params=index_params)
+# 4. Only embed and insert the sentences that changed since the last sync, a rebuild inserts
+# all of them and writes the manifest of the next --incremental run. A sentence is its own
+# key, so an edited sentence is deleted and added again rather than updated.
+report = sync(
+    {sentence: sentence for sentence in dict.fromkeys(sentences)},
+    args.manifest,
+    {"collection": collection_name, "model": "all-MiniLM-L6-v2", "projection": projection.fingerprint() if projection else None},
+    embed=lambda texts: model.encode(texts).tolist(),
+    insert=lambda keys, texts, embeddings: store.add(embeddings, texts, ids=texts),
+    delete=store.delete,
+    reset=rebuild or not collection_exists
+)
+print(f"Synced collection '{collection_name}': {report}")
+
+# 5. Seal the inserted data
+if report["added"] or report["updated"] or report["deleted"]:
+    store.flush()
+
+# 6. Create an index on the embedding field, IVF_FLAT unless VECTOR_INDEX is IVF_SQ8 or IVF_PQ
+store.create_index(index_params("COSINE", 100, dim))
 
 # 7. Load the collection into memory
-collection.load()
+store.load()
 
 # 8. Encode the query
 # query = "How do I optimize image loading times?" # ✅
@@ -72,19 +89,12 @@ query = "How I done any database migrations?"
 
 query_embedding = model.encode([query])
 
-# 9. Perform similarity search in Milvus
-search_params = {"metric_type": "COSINE", "params": {"nprobe": 10}}
-results = collection.search(
-    data=query_embedding,
-    anns_field="embedding",
-    param=search_params,
-    limit=1,
-    output_fields=["sentence"]
-)
+# 9. Perform similarity search in the vector store, which projects the query like the sentences
+results = store.search(query_embedding, 1, nprobe=10)
 
 # 10. Retrieve and print the most similar sentence
-if results:
-    most_similar_sentence = results[0][0].entity.get("sentence")
+if results[0]:
+    most_similar_sentence = results[0][0]["text"]
     print(f"Most similar sentence: {most_similar_sentence}")
 else:
     print("No similar sentences found.")
@@ -1,10 +1,21 @@
 # run the web api using `uvicorn sbert-milvus-webapi-example:app --reload`
 # docs page: http://127.0.0.1:8000/docs or http://127.0.0.1:8000/redoc
 
+from os import environ
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from sentence_transformers import SentenceTransformer
-from pymilvus import connections, FieldSchema, CollectionSchema, DataType, Collection, utility
+from pymilvus import FieldSchema, CollectionSchema, DataType, MilvusException
+from embedding_cache import EmbeddingCache, pack
+from projection import require_projection
+from vector_store import VECTOR_STORE, index_params, open_store, vector_field
+import asyncio
+import hashlib
+import time
 import uuid
 
 app = FastAPI()
@@ -12,9 +23,6 @@ app = FastAPI()
 # Load the Sentence Transformer model
 model = SentenceTransformer("F:\\SBERT-all-MiniLM-L6-v2")
 
-# Connect to Milvus
-connections.connect("default", host="localhost", port="19530")
-
 # Define the collection name
 collection_name = "sentence_embeddings_webapi"
 
@@ -42,38 +50,350 @@ default_sentences = [
     "Reviewed and merged pull requests to incorporate new features into the main codebase."
 ]
 
-# Define the collection schema
+# Reduce the embeddings with the PCA projection of the collection when PROJECTION_DIM is set,
+# fitted beforehand with projection.py
+projection = require_projection(collection_name)
+dim = projection.dim if projection else 384
+
+# Define the collection schema, the embedding field is float16 with VECTOR_TYPE=float16
 fields = [
     FieldSchema(name="id", dtype=DataType.VARCHAR, max_length=36, is_primary=True, auto_id=False),
     FieldSchema(name="sentence", dtype=DataType.VARCHAR, max_length=500),
-    FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=384)
+    vector_field(dim)
 ]
 schema = CollectionSchema(fields)
-collection = Collection(name=collection_name, schema=schema)
 
-# Insert default sentences into Milvus
+# Open the collection in the vector store selected with VECTOR_STORE (Milvus by default, see
+# vector_store.py), which projects the embeddings it inserts and the queries it searches for.
+# Session reads see the writes this process applied, which ?wait=true promises, without waiting
+# for the writes of every other client like Strong reads do; with the default Bounded consistency
+# a search right after a write could miss it and be cached until RESULT_CACHE_TTL_S.
+store, _ = open_store(collection_name, schema, metric="COSINE", id_field="id", text_field="sentence", projection=projection, consistency_level="Session")
+
+# Insert default sentences into the vector store
 def insert_default_sentences():
-    if collection.num_entities == 0:
+    if store.count() == 0:
         ids = [str(uuid.uuid4()) for _ in default_sentences]
-        embeddings = model.encode(default_sentences).tolist()
-        entities = [
-            ids,
-            default_sentences,
-            embeddings
-        ]
-        collection.insert(entities)
-        collection.flush()
-        # Create an index on the embedding field
-        index_params = {
-            "index_type": "IVF_FLAT",
-            "metric_type": "COSINE",
-            "params": {"nlist": 100}
-        }
-        collection.create_index(field_name="embedding", index_params=index_params)
-        collection.load()
+        embeddings = model.encode(default_sentences)
+        store.add(embeddings, default_sentences, ids)
+        store.flush()
+    # Create an index on the embedding field, IVF_FLAT unless VECTOR_INDEX is IVF_SQ8 or IVF_PQ
+    store.create_index(index_params("COSINE", 100, dim))
+    store.load()
 
 insert_default_sentences()
 
+# Inference executor: requests await a future while a background task gathers the queued
+# sentences into batches of up to ENCODE_BATCH_SIZE sentences, waiting at most ENCODE_WINDOW_MS
+# milliseconds for a batch to fill, and encodes them on ENCODE_THREADS threads
+ENCODE_BATCH_SIZE = int(environ.get("ENCODE_BATCH_SIZE", 64))
+ENCODE_WINDOW_MS = float(environ.get("ENCODE_WINDOW_MS", 5))
+ENCODE_THREADS = int(environ.get("ENCODE_THREADS", 1))
+
+# Blocking vector store calls run on a bounded pool of MILVUS_THREADS threads, off the event loop
+MILVUS_THREADS = int(environ.get("MILVUS_THREADS", 8))
+milvus_executor = ThreadPoolExecutor(max_workers=MILVUS_THREADS, thread_name_prefix="milvus")
+
+async def run_milvus(function, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(milvus_executor, partial(function, *args, **kwargs))
+
+class InferenceExecutor:
+    def __init__(self, max_batch, window, threads):
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(threads)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="encoder")
+        # The event loop only keeps weak references to tasks, an in-flight batch is kept here
+        # until it is done
+        self.batches = set()
+
+    async def encode(self, sentences):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentences, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for a free thread first, the queue keeps filling up while every thread is busy
+            await self.slots.acquire()
+            requests = [await self.queue.get()]
+            size = len(requests[0][0])
+            deadline = loop.time() + self.window
+            while size < self.max_batch:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self.queue.get_nowait()
+                requests.append(request)
+                size += len(request[0])
+            task = asyncio.create_task(self.encode_batch(requests))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+
+    async def encode_batch(self, requests):
+        try:
+            sentences = [sentence for request_sentences, _ in requests for sentence in request_sentences]
+            embeddings = await asyncio.get_running_loop().run_in_executor(self.executor, partial(model.encode, sentences, batch_size=self.max_batch))
+        except Exception as error:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            # Hand every request its own slice of the batch
+            start = 0
+            for request_sentences, future in requests:
+                if not future.done():
+                    future.set_result(embeddings[start:start + len(request_sentences)])
+                start += len(request_sentences)
+        finally:
+            self.slots.release()
+
+inference = None
+
+# Two-level search cache: query text -> embedding in an LRU of QUERY_CACHE_MAX_MB megabytes, and
+# (embedding hash, top_k, search params) -> hits for RESULT_CACHE_TTL_S seconds in an LRU of
+# RESULT_CACHE_SIZE entries. Every applied write bumps the collection version, which drops the
+# cached hits. A budget or size of 0 disables a level.
+QUERY_CACHE_MAX_MB = float(environ.get("QUERY_CACHE_MAX_MB", 32))
+RESULT_CACHE_SIZE = int(environ.get("RESULT_CACHE_SIZE", 10000))
+RESULT_CACHE_TTL_S = float(environ.get("RESULT_CACHE_TTL_S", 60))
+
+class ResultCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.version = 0
+        self.stats = {"hits": 0, "misses": 0, "expirations": 0, "evictions": 0}
+
+    def key(self, embedding, top_k, nprobe, filter):
+        # The key holds the collection version at the time of the search, so hits of a search
+        # that overlapped a write are never returned after the write
+        return (self.version, hashlib.sha256(pack(embedding)).hexdigest(), top_k, nprobe, filter)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self.entries[key]
+            self.stats["expirations"] += 1
+            entry = None
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, key, hits):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, hits)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self):
+        self.version += 1
+        self.entries.clear()
+
+    def clear(self):
+        self.entries.clear()
+
+    def counters(self):
+        return dict(self.stats, entries=len(self.entries), version=self.version)
+
+query_cache = EmbeddingCache("all-MiniLM-L6-v2", int(QUERY_CACHE_MAX_MB * 1024 * 1024))
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL_S)
+
+# Write-behind buffer: the write endpoints queue their writes and return right away. A background
+# task encodes the queued sentences through the inference executor and applies the writes to
+# Milvus once WRITE_BATCH_SIZE writes are queued or WRITE_INTERVAL_MS milliseconds passed.
+# Endpoints called with ?wait=true only return once their write is applied (read-your-writes).
+# A batch that fails is queued again and retried with a growing delay, a write is only dropped
+# after WRITE_MAX_ATTEMPTS failed attempts. The local vector store only reaches the disk on a
+# flush, so it is flushed after a batch once LOCAL_FLUSH_INTERVAL_S seconds passed since the
+# last one (0 flushes after every batch).
+WRITE_BATCH_SIZE = int(environ.get("WRITE_BATCH_SIZE", 256))
+WRITE_INTERVAL_MS = float(environ.get("WRITE_INTERVAL_MS", 100))
+WRITE_MAX_ATTEMPTS = int(environ.get("WRITE_MAX_ATTEMPTS", 5))
+WRITE_RETRY_MAX_S = float(environ.get("WRITE_RETRY_MAX_S", 5))
+LOCAL_FLUSH_INTERVAL_S = float(environ.get("LOCAL_FLUSH_INTERVAL_S", 10))
+
+def apply_writes(writes, embeddings):
+    # writes maps an id to (sentence, replaces), a None sentence deletes the row and replaces
+    # tells whether a previous version of the row may exist
+    inserts = {id: sentence for id, (sentence, _) in writes.items() if sentence is not None}
+
+    # Deleting first also removes the previous version of the updated sentences
+    deletes = [id for id, (_, replaces) in writes.items() if replaces]
+    if deletes:
+        store.delete(deletes)
+    if inserts:
+        store.add(embeddings, list(inserts.values()), list(inserts))
+
+class WriteBuffer:
+    def __init__(self, max_size, interval, max_attempts=WRITE_MAX_ATTEMPTS):
+        self.max_size = max_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.pending = {}
+        self.applying = {}
+        # (ids, future) of the writes called with wait=True
+        self.waiters = []
+        # id -> failed attempts of the pending write
+        self.attempts = {}
+        self.stats = {"applied": 0, "retried": 0, "failed": 0}
+        self.stopping = False
+        self.flushed_at = time.time()
+        self.has_writes = asyncio.Event()
+        self.is_full = asyncio.Event()
+        # A single writer thread applies the batches in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="milvus-writer")
+
+    async def write(self, writes, wait=False):
+        # writes is a list of (id, sentence, replaces), the last write of an id wins but a row
+        # written earlier must still be replaced
+        if not writes:
+            return
+        for id, sentence, replaces in writes:
+            if id in self.pending:
+                replaces = replaces or self.pending[id][1]
+            self.pending[id] = (sentence, replaces)
+        self.has_writes.set()
+        if len(self.pending) >= self.max_size:
+            self.is_full.set()
+
+        if wait:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(([id for id, _, _ in writes], waiter))
+            await waiter
+
+    def get(self, id):
+        # Returns (found, sentence) for the writes that are not applied yet
+        for writes in (self.pending, self.applying):
+            if id in writes:
+                return True, writes[id][0]
+        return False, None
+
+    def stop(self):
+        # run() applies the queued writes, then returns
+        self.stopping = True
+        self.has_writes.set()
+
+    async def run(self):
+        failures = 0
+        while True:
+            await self.has_writes.wait()
+            if not self.stopping:
+                try:
+                    await asyncio.wait_for(self.is_full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            if await self.flush():
+                failures = 0
+            else:
+                failures += 1
+                await asyncio.sleep(min(self.interval * 2 ** failures, WRITE_RETRY_MAX_S))
+            if self.stopping and not self.pending:
+                return
+
+    async def flush(self):
+        # Returns whether the queued writes were applied
+        writes, waiters = self.pending, self.waiters
+        self.pending, self.waiters = {}, []
+        self.has_writes.clear()
+        self.is_full.clear()
+        if not writes:
+            self.resolve(waiters)
+            return True
+
+        self.applying = writes
+        try:
+            sentences = [sentence for sentence, _ in writes.values() if sentence is not None]
+            embeddings = (await inference.encode(sentences)).tolist() if sentences else []
+            await asyncio.get_running_loop().run_in_executor(self.executor, apply_writes, writes, embeddings)
+            if VECTOR_STORE == "local" and time.time() - self.flushed_at >= LOCAL_FLUSH_INTERVAL_S:
+                await asyncio.get_running_loop().run_in_executor(self.executor, store.flush)
+                self.flushed_at = time.time()
+        except Exception as error:
+            self.requeue(writes, waiters, error)
+            return False
+        else:
+            self.stats["applied"] += len(writes)
+            for id in writes:
+                self.attempts.pop(id, None)
+            self.resolve(waiters)
+            return True
+        finally:
+            self.applying = {}
+            # Cached search results may not reflect the collection any more
+            result_cache.invalidate()
+
+    def resolve(self, waiters):
+        for _, waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def requeue(self, writes, waiters, error):
+        # The batch may be partly applied, so a retried write always replaces its row. A write
+        # queued since for the same id is newer and wins.
+        dropped = set()
+        for id, (sentence, _) in writes.items():
+            self.attempts[id] = self.attempts.get(id, 0) + 1
+            if self.attempts[id] >= self.max_attempts:
+                dropped.add(id)
+                self.attempts.pop(id)
+            elif id in self.pending:
+                self.pending[id] = (self.pending[id][0], True)
+            else:
+                self.pending[id] = (sentence, True)
+        self.stats["retried"] += len(writes) - len(dropped)
+        self.stats["failed"] += len(dropped)
+        print(f"Failed to apply {len(writes)} writes, retrying {len(writes) - len(dropped)} and dropping {len(dropped)}: {error}")
+
+        # Waiters of dropped writes fail, the others wait for the retry
+        for ids, waiter in waiters:
+            if waiter.done():
+                continue
+            if dropped.intersection(ids):
+                waiter.set_exception(error)
+            else:
+                self.waiters.append((ids, waiter))
+        if self.pending:
+            self.has_writes.set()
+
+    def counters(self):
+        return dict(self.stats, pending=len(self.pending))
+
+write_buffer = None
+background_tasks = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    global inference, write_buffer
+    inference = InferenceExecutor(ENCODE_BATCH_SIZE, ENCODE_WINDOW_MS / 1000, ENCODE_THREADS)
+    write_buffer = WriteBuffer(WRITE_BATCH_SIZE, WRITE_INTERVAL_MS / 1000)
+    background_tasks.append(asyncio.create_task(inference.run()))
+    background_tasks.append(asyncio.create_task(write_buffer.run()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    # Apply the queued writes, including a flush in progress, and seal the segments before
+    # exiting; the inference executor keeps running until the last writes are encoded
+    write_buffer.stop()
+    await background_tasks[1]
+    background_tasks[0].cancel()
+    await run_milvus(store.flush)
+
 # Pydantic models for request bodies
 class Sentence(BaseModel):
     sentence: str
@@ -82,64 +402,118 @@ class UpdateSentence(BaseModel):
     id: str
     sentence: str
 
+class Sentences(BaseModel):
+    sentences: List[str]
+
+class BatchSearch(BaseModel):
+    queries: List[str]
+    top_k: int = Field(10, ge=1, le=16384)
+    nprobe: int = Field(10, ge=1, le=65536)
+    # Optional Milvus boolean expression, e.g. id in ["..."]
+    filter: Optional[str] = None
+
 # CRUD Endpoints
 @app.post("/add_sentence/")
-async def add_sentence(sentence: Sentence):
+async def add_sentence(sentence: Sentence, wait: bool = False):
     id = str(uuid.uuid4())
-    embedding = model.encode([sentence.sentence]).tolist()
-    entities = [
-        [id],
-        [sentence.sentence],
-        embedding
-    ]
-    collection.insert(entities)
-    collection.flush()
+    await write_buffer.write([(id, sentence.sentence, False)], wait=wait)
     return {"id": id, "sentence": sentence.sentence}
 
+@app.post("/add_sentences/")
+async def add_sentences(sentences: Sentences, wait: bool = False):
+    ids = [str(uuid.uuid4()) for _ in sentences.sentences]
+    await write_buffer.write([(id, sentence, False) for id, sentence in zip(ids, sentences.sentences)], wait=wait)
+    return [{"id": id, "sentence": sentence} for id, sentence in zip(ids, sentences.sentences)]
+
 @app.delete("/delete_sentence/{sentence_id}")
-async def delete_sentence(sentence_id: str):
-    expr = f'id == "{sentence_id}"'
-    collection.delete(expr)
-    collection.flush()
+async def delete_sentence(sentence_id: str, wait: bool = False):
+    await write_buffer.write([(sentence_id, None, True)], wait=wait)
     return {"message": f"Sentence with id {sentence_id} deleted."}
 
 @app.put("/update_sentence/")
-async def update_sentence(update: UpdateSentence):
-    expr = f'id == "{update.id}"'
-    collection.delete(expr)
-    embedding = model.encode([update.sentence]).tolist()
-    entities = [
-        [update.id],
-        [update.sentence],
-        embedding
-    ]
-    collection.insert(entities)
-    collection.flush()
+async def update_sentence(update: UpdateSentence, wait: bool = False):
+    await write_buffer.write([(update.id, update.sentence, True)], wait=wait)
     return {"id": update.id, "sentence": update.sentence}
 
 @app.get("/get_sentence/{sentence_id}")
 async def get_sentence(sentence_id: str):
-    expr = f'id == "{sentence_id}"'
-    results = collection.query(expr, output_fields=["sentence"])
-    if results:
-        return {"id": sentence_id, "sentence": results[0]["sentence"]}
+    # Writes that are not applied yet are answered from the write buffer
+    found, sentence = write_buffer.get(sentence_id)
+    if found:
+        if sentence is None:
+            raise HTTPException(status_code=404, detail="Sentence not found.")
+        return {"id": sentence_id, "sentence": sentence}
+
+    sentence = await run_milvus(store.get, sentence_id)
+    if sentence is not None:
+        return {"id": sentence_id, "sentence": sentence}
     else:
         raise HTTPException(status_code=404, detail="Sentence not found.")
 
-# Similarity Search Endpoint
+# Similarity Search Endpoints
+async def encode_queries(queries):
+    keys = [query_cache.key("query", query) for query in queries]
+    embeddings = query_cache.get_many(keys)
+
+    # Only encode the queries that are not cached, each distinct query once
+    missing = {}
+    for key, query in zip(keys, queries):
+        if key not in embeddings:
+            missing.setdefault(key, query)
+    if missing:
+        encoded = dict(zip(missing, (await inference.encode(list(missing.values()))).tolist()))
+        query_cache.put_many(encoded)
+        embeddings.update(encoded)
+
+    return [embeddings[key] for key in keys]
+
+async def search_sentences(queries, top_k, nprobe, filter=None):
+    query_embeddings = await encode_queries(queries)
+    keys = [result_cache.key(embedding, top_k, nprobe, filter) for embedding in query_embeddings]
+    hits = [result_cache.get(key) for key in keys]
+
+    # One multi-vector search for all the queries whose hits are not cached, the store projects
+    # the full-dimensional query embeddings
+    missing = [index for index, query_hits in enumerate(hits) if query_hits is None]
+    if missing:
+        try:
+            results = await run_milvus(store.search, [query_embeddings[index] for index in missing], top_k, nprobe=nprobe, filter=filter)
+        except (MilvusException, ValueError) as error:
+            if filter:
+                raise HTTPException(status_code=400, detail=f"Search failed, check the filter expression: {error}")
+            raise
+        for index, result in zip(missing, results):
+            hits[index] = [{"id": hit["id"], "sentence": hit["text"], "score": hit["score"]} for hit in result]
+            result_cache.put(keys[index], hits[index])
+
+    return hits
+
+@app.post("/similarity_search/batch")
+async def similarity_search_batch(search: BatchSearch):
+    if not search.queries:
+        return {"results": []}
+    hits = await search_sentences(search.queries, search.top_k, search.nprobe, search.filter)
+    return {"results": [{"query": query, "hits": query_hits} for query, query_hits in zip(search.queries, hits)]}
+
 @app.post("/similarity_search/")
 async def similarity_search(query: Sentence):
-    query_embedding = model.encode([query.sentence])
-    search_params = {"metric_type": "COSINE", "params": {"nprobe": 10}}
-    results = collection.search(
-        data=query_embedding,
-        anns_field="embedding",
-        param=search_params,
-        limit=1,
-        output_fields=["sentence"]
-    )
-    if results:
-        most_similar_sentence = results[0][0].entity.get("sentence")
-        return {"query": query.sentence, "most_similar_sentence": most_similar_sentence}
+    hits = (await search_sentences([query.sentence], top_k=1, nprobe=10))[0]
+    if hits:
+        return {"query": query.sentence, "most_similar_sentence": hits[0]["sentence"]}
     else:
         return {"query": query.sentence, "most_similar_sentence": None}
+
+@app.get("/write_buffer/stats")
+async def write_buffer_stats():
+    return write_buffer.counters()
+
+# Cache Endpoints
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"query_embeddings": query_cache.counters(), "search_results": result_cache.counters()}
+
+@app.post("/cache/clear")
+async def cache_clear():
+    query_cache.clear()
+    result_cache.clear()
+    return {"message": "Caches cleared."}
@@ -0,0 +1,215 @@
+# Metrics, structured logging and a sampling profiler for the embedding worker, with the
+# standard library only:
+# - Counter, Gauge and Histogram render in the Prometheus text format on GET /metrics of
+#   start_metrics_server(port), which also answers GET /ready with the readiness dict: 200
+#   once readiness["ready"] is set, 503 before
+# - log() prints one line per event, plain text or JSON with LOG_FORMAT=json, filtered by LOG_LEVEL
+# - SIGUSR1 toggles a sampling profiler, which writes collapsed stacks (the flame graph input
+#   format) to PROFILE_DIR when it is turned off
+
+from os import environ, getpid, makedirs, path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import json
+import sys
+import threading
+import time
+
+LOG_FORMAT = environ.get("LOG_FORMAT", "text")
+LOG_LEVEL = environ.get("LOG_LEVEL", "info")
+PROFILE_DIR = environ.get("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(environ.get("PROFILE_INTERVAL_MS", 10))
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+# Latency buckets in seconds, from a cached query to a long code request on CPU
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+metrics = []
+readiness = {"ready": False}
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self, kind="counter"):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+class Gauge(Counter):
+    def __init__(self, name, documentation, labels=(), collect=None):
+        # collect() returns the current value at every scrape, instead of set() and inc()
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.collect is not None:
+            for key, value in self.collect().items():
+                self.set(value, **dict(zip(self.labels, key if isinstance(key, tuple) else (key,))))
+        return super().render("gauge")
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            # Counts per bucket, the sum and the count of the observations
+            counts, total, count = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0, 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucketCount in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucketCount
+                    lines.append(f"{self.name}_bucket{format_labels(names, key + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+class Timer:
+    # with histogram.time(stage="infer"): observes the duration of the block in seconds
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter() - self.startTime
+        self.histogram.observe(self.duration, **self.labels)
+
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        route = self.path.split("?")[0]
+        if route == "/metrics":
+            status, contentType, body = 200, "text/plain; version=0.0.4; charset=utf-8", render_metrics().encode("utf-8")
+        elif route == "/ready":
+            status, contentType, body = 200 if readiness.get("ready") else 503, "application/json", json.dumps(readiness).encode("utf-8")
+        else:
+            self.send_error(404)
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the worker logs
+        pass
+
+def start_metrics_server(port, host="0.0.0.0"):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+def log(event, message, level="info", **fields):
+    if LOG_LEVELS.get(level, 20) < LOG_LEVELS.get(LOG_LEVEL, 20):
+        return
+    if LOG_FORMAT == "json":
+        record = {"ts": round(time.time(), 3), "level": level, "pid": getpid(), "event": event, "message": message}
+        record.update(fields)
+        print(json.dumps(record, default=str), flush=True)
+    else:
+        print(message, flush=True)
+
+class Profiler:
+    # Samples the stacks of every thread of the process, without instrumenting the code
+    def __init__(self, interval=PROFILE_INTERVAL_MS / 1000, directory=PROFILE_DIR):
+        self.interval = interval
+        self.directory = directory
+        self.stacks = {}
+        self.samples = 0
+        self.running = threading.Event()
+        self.thread = None
+
+    def toggle(self, *signal_args):
+        # Usable as a signal handler: the sampling thread is started or stopped, never joined here
+        if self.running.is_set():
+            self.running.clear()
+        else:
+            self.stacks = {}
+            self.samples = 0
+            self.running.set()
+            self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        startTime = time.time()
+        log("profiler_started", f"Profiler started in process {getpid()}, sampling every {self.interval * 1000} ms")
+        own = threading.get_ident()
+        while self.running.is_set():
+            for threadId, frame in sys._current_frames().items():
+                if threadId == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+        self.write(startTime)
+
+    def write(self, startTime):
+        makedirs(self.directory, exist_ok=True)
+        file_path = path.join(self.directory, f"profile-{getpid()}-{int(startTime)}.collapsed")
+        with open(file_path, "w") as file:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                file.write(f"{stack} {count}\n")
+        log("profiler_stopped", f"Profiler stopped after {self.samples} samples, collapsed stacks written to {file_path}", samples=self.samples, path=file_path)
+
+profiler = Profiler()
@@ -0,0 +1,80 @@
+import hashlib
+import importlib.util
+import os
+import numpy as np
+import pytest
+import vector_store
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def bulk_index(monkeypatch, tmp_path):
+    # bulk-index.py is a script, loaded from its path; the model is replaced by hashed vectors
+    # and the collection is kept in the local vector store
+    spec = importlib.util.spec_from_file_location("bulk_index", os.path.join(ROOT, "bulk-index.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module, "load_model", lambda: None)
+    monkeypatch.setattr(module, "tokenize_contents", lambda contents, requestType: (list(contents), [1] * len(contents)))
+    monkeypatch.setattr(module, "embed_tokenized", lambda windows, chunk_counts, requestType: [fake_embedding(window) for window in windows])
+    monkeypatch.setattr(vector_store, "VECTOR_STORE", "local")
+    monkeypatch.setattr(vector_store, "VECTOR_STORE_PATH", str(tmp_path / "vector-store"))
+    return module
+
+def fake_embedding(content):
+    seed = int.from_bytes(hashlib.sha256(content.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(768)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+def test_extract_methods_skips_verbatim_strings(bulk_index):
+    source = '''
+public class Paths
+{
+    public string Temp() { return @"C:\\temp\\"; }
+    public string Quoted() { return @"say ""}"" twice"; }
+    public string Interpolated(string name) { return $@"C:\\{name}\\"; }
+    public int Count() { return 1; }
+}
+'''
+    methods = list(bulk_index.extract_methods(source))
+    assert [method.split("(")[0].split()[-1] for method in methods] == ["Temp", "Quoted", "Interpolated", "Count"]
+    assert methods[0] == 'public string Temp() { return @"C:\\temp\\"; }'
+    assert methods[1] == 'public string Quoted() { return @"say ""}"" twice"; }'
+
+def write_tree(root, files, methods):
+    for file_index in range(files):
+        body = "\n".join(f"    public int Method{file_index}_{index}() {{ return {index}; }}" for index in range(methods))
+        (root / f"Class{file_index}.cs").write_text(f"public class Class{file_index}\n{{\n{body}\n}}\n")
+
+def test_bulk_index_resumes_from_checkpoint(bulk_index, monkeypatch, tmp_path):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    write_tree(tree, files=3, methods=10)
+    checkpoint = str(tmp_path / "checkpoint.json")
+
+    # The first run fails on the third batch of 8 snippets, after inserting one or two
+    embed = bulk_index.embed_batch
+    calls = []
+    def failing_embed_batch(item):
+        calls.append(item)
+        if len(calls) > 2:
+            raise RuntimeError("model crashed")
+        return embed(item)
+    monkeypatch.setattr(bulk_index, "embed_batch", failing_embed_batch)
+    with pytest.raises(RuntimeError):
+        bulk_index.bulk_index(str(tree), (".cs",), "method", 8, 8, 1, checkpoint, restart=True)
+    interrupted = bulk_index.read_checkpoint(checkpoint, str(tree))
+    assert interrupted["inserted"] in (8, 16)
+    assert not interrupted["completed"]
+
+    # The second run resumes after the inserted snippets
+    monkeypatch.setattr(bulk_index, "embed_batch", embed)
+    bulk_index.bulk_index(str(tree), (".cs",), "method", 8, 8, 1, checkpoint, restart=False)
+    assert bulk_index.read_checkpoint(checkpoint, str(tree))["completed"]
+
+    store = vector_store.LocalStore(os.path.join(vector_store.VECTOR_STORE_PATH, bulk_index.COLLECTION_NAME), "IP")
+    texts = list(store.texts)
+    assert len(texts) == 30
+    assert len(set(texts)) == 30
+    hits = store.search([fake_embedding("public int Method1_4() { return 4; }")], 1)
+    assert hits[0][0]["text"] == "public int Method1_4() { return 4; }"
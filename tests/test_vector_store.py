@@ -0,0 +1,30 @@
+import numpy as np
+from vector_store import LocalStore
+
+def normalized(rows, dim, seed):
+    vectors = np.random.default_rng(seed).standard_normal((rows, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def test_ivf_store_searches_after_add_flush_and_reload(tmp_path):
+    # More rows than the clusters need to train, in a store whose capacity grew past its size
+    vectors = normalized(5000, 32, seed=0)
+    store = LocalStore(str(tmp_path), "COSINE", "ivf")
+    for start in range(0, len(vectors), 1000):
+        store.add(vectors[start:start + 1000], [f"snippet {row}" for row in range(start, start + 1000)])
+    assert len(store.vectors) > store.size
+
+    hits = store.search(vectors[:3], 5, nprobe=100)
+    assert [query_hits[0]["id"] for query_hits in hits] == [0, 1, 2]
+    assert store.centroids is not None
+    store.flush()
+
+    reloaded = LocalStore(str(tmp_path), "COSINE", "ivf")
+    assert reloaded.count() == len(vectors)
+    assert reloaded.centroids is not None
+    hits = reloaded.search(vectors[10:12], 5, nprobe=100)
+    assert [query_hits[0]["text"] for query_hits in hits] == ["snippet 10", "snippet 11"]
+
+    # Vectors added after the reload join the clusters trained before it
+    added = normalized(10, 32, seed=1)
+    reloaded.add(added, [f"added {row}" for row in range(len(added))])
+    assert reloaded.search(added[:1], 1, nprobe=100)[0][0]["text"] == "added 0"
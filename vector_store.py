@@ -0,0 +1,494 @@
+from os import environ
+import copy
+import json
+import os
+import re
+import threading
+import numpy as np
+
+# Vector stores behind one interface (add/upsert/delete/get/search), selected with VECTOR_STORE:
+# - milvus: a Milvus collection (MILVUS_URI, or MILVUS_HOST and MILVUS_PORT)
+# - local: an in-process index, exact search over a float32 matrix (LOCAL_INDEX=flat) or an
+#   inverted file index probing the nearest k-means clusters (LOCAL_INDEX=ivf), persisted in
+#   VECTOR_STORE_PATH and memory-mapped on load
+# Search hits are {"id", "text", "score"} dicts, best first.
+#
+# Vectors are stored as float32, or as float16 with VECTOR_TYPE=float16 (a FLOAT16_VECTOR field
+# in Milvus), which halves their memory. VECTOR_INDEX picks the Milvus index: IVF_FLAT, IVF_SQ8
+# (one byte per dimension) or IVF_PQ (PQ_M bytes per vector). A store opened with a projection
+# (see projection.py) reduces the vectors it adds and the queries it searches for.
+VECTOR_STORE = environ.get("VECTOR_STORE", "milvus")
+LOCAL_INDEX = environ.get("LOCAL_INDEX", "flat")
+VECTOR_STORE_PATH = environ.get("VECTOR_STORE_PATH", "vector-store")
+VECTOR_TYPE = environ.get("VECTOR_TYPE", "float32")
+VECTOR_INDEX = environ.get("VECTOR_INDEX", "IVF_FLAT")
+PQ_M = int(environ.get("PQ_M", 0))
+
+MILVUS_HOST = environ.get("MILVUS_HOST", "localhost")
+MILVUS_PORT = environ.get("MILVUS_PORT", "19530")
+MILVUS_URI = environ.get("MILVUS_URI")
+
+def vector_field(dim, name="embedding", vector_type=VECTOR_TYPE):
+    from pymilvus import DataType, FieldSchema
+    if vector_type not in ("float32", "float16"):
+        raise ValueError(f"Unknown vector type: {vector_type}, expected float32 or float16")
+    return FieldSchema(name=name, dtype=DataType.FLOAT16_VECTOR if vector_type == "float16" else DataType.FLOAT_VECTOR, dim=dim)
+
+def index_params(metric, nlist, dim, index_type=VECTOR_INDEX):
+    params = {"nlist": nlist}
+    if index_type == "IVF_PQ":
+        # The number of sub-quantizers must divide the dimension, 8 dimensions each by default
+        params["m"] = PQ_M or next(m for m in range(max(dim // 8, 1), 0, -1) if dim % m == 0)
+        params["nbits"] = 8
+    elif index_type not in ("IVF_FLAT", "IVF_SQ8"):
+        raise ValueError(f"Unknown vector index: {index_type}, expected IVF_FLAT, IVF_SQ8 or IVF_PQ")
+    return {"index_type": index_type, "metric_type": metric, "params": params}
+
+def delete_expression(field, primary_keys):
+    # Milvus boolean expression matching the given primary keys, e.g. id in [1, 2]
+    return f"{field} in {json.dumps(list(primary_keys))}"
+
+class MilvusStore:
+    def __init__(self, collection, id_field, text_field, metric, vector_field="embedding", projection=None, consistency_level=None):
+        self.collection = collection
+        self.id_field = id_field
+        self.text_field = text_field
+        self.vector_field = vector_field
+        self.metric = metric
+        self.projection = projection
+        # Reads use the consistency level of the collection (Bounded by default) unless set,
+        # "Session" makes every get and search see the writes this client applied before it
+        self.read_options = {"consistency_level": consistency_level} if consistency_level else {}
+        self.float16 = any(field.name == vector_field and field.dtype.name == "FLOAT16_VECTOR" for field in collection.schema.fields)
+
+    def _vectors(self, vectors):
+        if self.projection is not None:
+            vectors = self.projection.apply(vectors)
+        # pymilvus takes float16 vectors as numpy arrays and float32 vectors as lists
+        if self.float16:
+            return list(np.asarray(vectors, dtype=np.float16))
+        return np.asarray(vectors, dtype=np.float32).tolist()
+
+    def add(self, vectors, texts, ids=None):
+        # Columns in the order of the schema, without the primary key when Milvus generates it
+        columns = {self.id_field: ids, self.text_field: list(texts), self.vector_field: self._vectors(vectors)}
+        data = [columns[field.name] for field in self.collection.schema.fields if not (field.is_primary and field.auto_id)]
+        return list(self.collection.insert(data).primary_keys)
+
+    def upsert(self, ids, vectors, texts):
+        self.delete(ids)
+        return self.add(vectors, texts, ids)
+
+    def delete(self, ids):
+        if ids:
+            self.collection.delete(delete_expression(self.id_field, ids))
+
+    def get(self, id):
+        results = self.collection.query(f"{self.id_field} == {json.dumps(id)}", output_fields=[self.text_field], **self.read_options)
+        return results[0][self.text_field] if results else None
+
+    def search(self, vectors, top_k, nprobe=10, filter=None):
+        results = self.collection.search(
+            data=self._vectors(vectors),
+            anns_field=self.vector_field,
+            param={"metric_type": self.metric, "params": {"nprobe": nprobe}},
+            limit=top_k,
+            expr=filter,
+            output_fields=[self.text_field],
+            **self.read_options
+        )
+        return [[{"id": hit.id, "text": hit.entity.get(self.text_field), "score": hit.score} for hit in hits] for hits in results]
+
+    def count(self):
+        return self.collection.num_entities
+
+    def create_index(self, index_params):
+        if not self.collection.has_index():
+            self.collection.create_index(field_name=self.vector_field, index_params=index_params)
+
+    def load(self):
+        self.collection.load()
+
+    def flush(self):
+        self.collection.flush()
+
+# Read-only sequence of values stored as one memory-mapped UTF-8 blob and their offsets
+class PackedStrings:
+    def __init__(self, blob, offsets, decode):
+        self.blob = blob
+        self.offsets = offsets
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.decode(bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]).decode("utf-8"))
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+# Filters supported by the local store: <field> == value, != value, in [values] or not in [values],
+# with JSON values
+LOCAL_FILTER = re.compile(r"^\s*(\w+)\s+(==|!=|in|not in)\s+(.+?)\s*$")
+SEARCH_BLOCK_ROWS = 262144
+
+class LocalStore:
+    def __init__(self, path=None, metric="COSINE", index="flat", id_field="id", text_field="text", auto_id=False, dtype=np.float32, projection=None):
+        self.path = path
+        self.metric = metric
+        self.index = index
+        self.id_field = id_field
+        self.text_field = text_field
+        self.auto_id = auto_id
+        # Storage type of the vectors, they are scored in float32 either way
+        self.dtype = np.dtype(dtype)
+        self.projection = projection
+        self.nlist = 100
+        self.lock = threading.RLock()
+
+        self.vectors = None
+        self.size = 0
+        self.live = np.zeros(0, dtype=bool)
+        self.ids = []
+        self.texts = []
+        self.rows = None
+        self.next_id = 0
+        self.deleted = 0
+        self.centroids = None
+        self.assignments = None
+        self.trained_size = 0
+        # Whether a search is training the clusters, and a counter of the compactions, which
+        # renumber the rows
+        self.training = False
+        self.layout = 0
+        self.dirty = False
+
+        if path and os.path.exists(os.path.join(path, "meta.json")):
+            self._load()
+
+    def add(self, vectors, texts, ids=None):
+        vectors = self._prepare(vectors)
+        texts = list(texts)
+        with self.lock:
+            if ids is None:
+                ids = list(range(self.next_id, self.next_id + len(texts)))
+            ids = list(ids)
+            self.delete([id for id in ids if id in self._rows()])
+            self._make_writable(self.size + len(ids), vectors.shape[1])
+
+            start = self.size
+            self.vectors[start:start + len(ids)] = vectors
+            self.live[start:start + len(ids)] = True
+            self.ids.extend(ids)
+            self.texts.extend(texts)
+            rows = self._rows()
+            for offset, id in enumerate(ids):
+                rows[id] = start + offset
+                if isinstance(id, int):
+                    self.next_id = max(self.next_id, id + 1)
+            if self.centroids is not None:
+                # New vectors join the inverted list of their nearest centroid
+                self.assignments[start:start + len(ids)] = self._nearest_centroids(vectors, 1)[:, 0]
+            self.size += len(ids)
+            self.dirty = True
+            return ids
+
+    def upsert(self, ids, vectors, texts):
+        return self.add(vectors, texts, ids)
+
+    def delete(self, ids):
+        with self.lock:
+            rows = self._rows()
+            for id in ids:
+                row = rows.pop(id, None)
+                if row is not None:
+                    self._make_writable(self.size, self.vectors.shape[1])
+                    self.live[row] = False
+                    self.deleted += 1
+                    self.dirty = True
+            # Reclaim the rows of the deleted vectors once they are the majority
+            if self.deleted > self.size // 2:
+                self._compact()
+
+    def get(self, id):
+        with self.lock:
+            row = self._rows().get(id)
+            return None if row is None else self.texts[row]
+
+    def count(self):
+        return self.size - self.deleted
+
+    def search(self, vectors, top_k, nprobe=10, filter=None):
+        queries = self._prepare(vectors)
+        # Only a snapshot is taken under the lock, searches score it without blocking each other
+        # or the writes: the rows of the snapshot never change, writes append rows past its size
+        # or replace the arrays it references
+        with self.lock:
+            if self.count() == 0:
+                return [[] for _ in queries]
+
+            allowed = self.live[:self.size].copy()
+            if filter:
+                allowed &= self._filter_mask(filter)
+            snapshot = copy.copy(self)
+
+            # The clusters are (re)built when there are none yet or the store doubled in size
+            # since, exact search is used while there are too few vectors for them
+            clustered = self.index == "ivf" and self.count() >= self.nlist * 39
+            train = clustered and not self.training and (self.centroids is None or self.size >= 2 * self.trained_size)
+            self.training = self.training or train
+
+        if train:
+            # Trained on the snapshot as well, concurrent searches keep the previous clusters
+            try:
+                snapshot._train()
+                with self.lock:
+                    self._install_clusters(snapshot)
+            finally:
+                self.training = False
+
+        if clustered and snapshot.centroids is not None:
+            # Only score the vectors of the nprobe clusters nearest to each query
+            probes = snapshot._nearest_centroids(queries, min(nprobe, len(snapshot.centroids)))
+            results = []
+            for query, query_probes in zip(queries, probes):
+                candidates = np.flatnonzero(np.isin(snapshot.assignments[:snapshot.size], query_probes) & allowed)
+                results.append(snapshot._top_k(query[None, :], candidates, top_k)[0])
+            return results
+
+        return snapshot._top_k(queries, np.flatnonzero(allowed), top_k)
+
+    def create_index(self, index_params):
+        # The local index is built on demand, only the number of clusters is taken from Milvus
+        # index parameters
+        self.nlist = index_params.get("params", {}).get("nlist", self.nlist)
+
+    def load(self):
+        pass
+
+    def flush(self):
+        with self.lock:
+            if self.path and self.dirty:
+                self._save()
+
+    def _prepare(self, vectors):
+        if self.projection is not None:
+            vectors = self.projection.apply(vectors)
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.metric == "COSINE":
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        return vectors
+
+    def _scores(self, queries, rows):
+        vectors = self.vectors[rows].astype(np.float32, copy=False)
+        if self.metric == "L2":
+            # Negative squared distances, so that a higher score is always better
+            return -(np.sum(queries ** 2, axis=1)[:, None] - 2 * queries @ vectors.T + np.sum(vectors ** 2, axis=1)[None, :])
+        return queries @ vectors.T
+
+    def _top_k(self, queries, candidates, top_k):
+        # Exact top-k over the candidate rows, block by block to bound the memory of the scores
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(candidates), SEARCH_BLOCK_ROWS):
+            rows = candidates[start:start + SEARCH_BLOCK_ROWS]
+            scores = np.concatenate([best_scores, self._scores(queries, rows)], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(rows, (len(queries), len(rows)))], axis=1)
+            k = min(top_k, scores.shape[1])
+            selected = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, selected, axis=1)
+            best_rows = np.take_along_axis(rows, selected, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        sign = -1 if self.metric == "L2" else 1
+        return [
+            [{"id": self.ids[row], "text": self.texts[row], "score": float(sign * score)} for row, score in zip(query_rows, query_scores)]
+            for query_rows, query_scores in zip(best_rows, best_scores)
+        ]
+
+    def _filter_mask(self, filter):
+        match = LOCAL_FILTER.match(filter)
+        if not match or match.group(1) not in (self.id_field, self.text_field):
+            raise ValueError(f"Unsupported filter for the local vector store: {filter}")
+        field, operator, value = match.groups()
+        value = json.loads(value)
+        values = value if operator in ("in", "not in") else [value]
+
+        mask = np.zeros(self.size, dtype=bool)
+        if field == self.id_field:
+            rows = self._rows()
+            mask[[rows[id] for id in values if id in rows]] = True
+        else:
+            wanted = set(values)
+            mask[[row for row in range(self.size) if self.texts[row] in wanted]] = True
+        return ~mask if operator in ("!=", "not in") else mask
+
+    def _train(self):
+        # k-means clusters of a sample of the live vectors, and the cluster of every row
+        live_rows = np.flatnonzero(self.live[:self.size])
+        random = np.random.default_rng(0)
+        sample = self.vectors[random.choice(live_rows, min(len(live_rows), self.nlist * 256), replace=False)].astype(np.float32, copy=False)
+        centroids = sample[random.choice(len(sample), self.nlist, replace=False)].copy()
+        for _ in range(20):
+            # Lloyd iterations, by inner product for normalized vectors
+            assigned = np.argmax(sample @ centroids.T, axis=1) if self.metric != "L2" else np.argmin(np.sum(sample ** 2, axis=1)[:, None] - 2 * sample @ centroids.T + np.sum(centroids ** 2, axis=1)[None, :], axis=1)
+            for cluster in range(self.nlist):
+                members = sample[assigned == cluster]
+                if len(members):
+                    centroids[cluster] = members.mean(axis=0)
+            if self.metric == "COSINE":
+                centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        self.centroids = centroids
+        self.assignments = np.zeros(self.size, dtype=np.int32)
+        for start in range(0, self.size, SEARCH_BLOCK_ROWS):
+            end = min(start + SEARCH_BLOCK_ROWS, self.size)
+            self.assignments[start:end] = self._nearest_centroids(self.vectors[start:end], 1)[:, 0]
+        self.trained_size = self.size
+
+    def _install_clusters(self, trained):
+        # Takes the clusters trained on a snapshot, the rows added since join their nearest
+        # cluster; after a compaction the rows do not match any more and the next search trains
+        if trained.layout != self.layout:
+            return
+        self.centroids = trained.centroids
+        assignments = np.zeros(len(self.vectors), dtype=np.int32)
+        assignments[:trained.size] = trained.assignments
+        if self.size > trained.size:
+            assignments[trained.size:self.size] = self._nearest_centroids(self.vectors[trained.size:self.size], 1)[:, 0]
+        self.assignments = assignments
+        self.trained_size = trained.trained_size
+        self.dirty = True
+
+    def _nearest_centroids(self, vectors, count):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.metric == "L2":
+            scores = -(np.sum(self.centroids ** 2, axis=1)[None, :] - 2 * vectors @ self.centroids.T)
+        else:
+            scores = vectors @ self.centroids.T
+        return np.argsort(-scores, axis=1)[:, :count]
+
+    def _rows(self):
+        # The id -> row map is only built when an id is looked up, a freshly loaded store does
+        # not need it to search
+        if self.rows is None:
+            self.rows = {id: row for row, id in enumerate(self.ids) if self.live[row]}
+        return self.rows
+
+    def _make_writable(self, capacity, dim):
+        # Grow the arrays geometrically, and copy memory-mapped arrays into memory on the first
+        # write
+        if self.vectors is not None and capacity <= len(self.vectors) and isinstance(self.vectors, np.ndarray) and not isinstance(self.vectors, np.memmap):
+            return
+        new_capacity = max(capacity, 2 * (len(self.vectors) if self.vectors is not None else 0), 1024)
+        vectors = np.zeros((new_capacity, dim), dtype=self.dtype)
+        live = np.zeros(new_capacity, dtype=bool)
+        if self.vectors is not None:
+            vectors[:self.size] = self.vectors[:self.size]
+            live[:self.size] = self.live[:self.size]
+        self.vectors, self.live = vectors, live
+        if self.assignments is not None:
+            assignments = np.zeros(new_capacity, dtype=np.int32)
+            assignments[:self.size] = self.assignments[:self.size]
+            self.assignments = assignments
+        if not isinstance(self.ids, list):
+            self.ids = list(self.ids)
+            self.texts = list(self.texts)
+
+    def _compact(self):
+        keep = np.flatnonzero(self.live[:self.size])
+        self.vectors = np.ascontiguousarray(self.vectors[keep])
+        self.live = np.ones(len(keep), dtype=bool)
+        if self.assignments is not None:
+            self.assignments = self.assignments[keep]
+        self.ids = [self.ids[row] for row in keep]
+        self.texts = [self.texts[row] for row in keep]
+        self.size = len(keep)
+        self.deleted = 0
+        self.rows = None
+        self.layout += 1
+        self.dirty = True
+
+    def _save(self):
+        if self.deleted:
+            self._compact()
+        os.makedirs(self.path, exist_ok=True)
+
+        def replace(name, write):
+            # Write every file next to its final name and swap it in, meta.json comes last
+            temporary = os.path.join(self.path, name + ".tmp")
+            with open(temporary, "wb") as file:
+                write(file)
+            os.replace(temporary, os.path.join(self.path, name))
+
+        def write_strings(name, values, encode):
+            blobs = [encode(value).encode("utf-8") for value in values]
+            replace(name + ".bin", lambda file: file.write(b"".join(blobs)))
+            replace(name + ".offsets.npy", lambda file: np.save(file, np.cumsum([0] + [len(blob) for blob in blobs], dtype=np.int64)))
+
+        replace("vectors.npy", lambda file: np.save(file, np.ascontiguousarray(self.vectors[:self.size])))
+        write_strings("ids", self.ids[:self.size], json.dumps)
+        write_strings("texts", self.texts[:self.size], str)
+        if self.centroids is not None:
+            replace("centroids.npy", lambda file: np.save(file, self.centroids))
+            replace("assignments.npy", lambda file: np.save(file, self.assignments[:self.size]))
+        meta = {"metric": self.metric, "size": self.size, "next_id": self.next_id, "trained_size": self.trained_size, "clustered": self.centroids is not None}
+        replace("meta.json", lambda file: file.write(json.dumps(meta).encode("utf-8")))
+        self.dirty = False
+
+    def _load(self):
+        # Memory-map everything, loading takes the same time whatever the size of the store
+        with open(os.path.join(self.path, "meta.json")) as file:
+            meta = json.load(file)
+        self.size = meta["size"]
+        self.next_id = meta["next_id"]
+        self.trained_size = meta["trained_size"]
+        self.vectors = np.load(os.path.join(self.path, "vectors.npy"), mmap_mode="r")
+        self.dtype = self.vectors.dtype
+        self.live = np.ones(self.size, dtype=bool)
+
+        def read_strings(name, decode):
+            offsets = np.load(os.path.join(self.path, name + ".offsets.npy"), mmap_mode="r")
+            blob_path = os.path.join(self.path, name + ".bin")
+            blob = np.memmap(blob_path, dtype=np.uint8, mode="r") if os.path.getsize(blob_path) else b""
+            return PackedStrings(blob, offsets, decode)
+
+        self.ids = read_strings("ids", json.loads)
+        self.texts = read_strings("texts", lambda text: text)
+        if meta["clustered"]:
+            self.centroids = np.load(os.path.join(self.path, "centroids.npy"))
+            self.assignments = np.load(os.path.join(self.path, "assignments.npy"), mmap_mode="r")
+
+def connect_milvus(uri=None):
+    from pymilvus import connections
+    uri = uri or MILVUS_URI
+    if not connections.has_connection("default"):
+        if uri:
+            connections.connect("default", uri=uri)
+        else:
+            connections.connect("default", host=MILVUS_HOST, port=MILVUS_PORT)
+
+def open_store(name, schema, metric, id_field, text_field, drop=False, milvus_uri=None, projection=None, consistency_level=None):
+    # Returns the store and whether it existed before, drop starts from an empty store. The
+    # vector field of the schema has the dimension of the projection when there is one.
+    if VECTOR_STORE == "local":
+        path = os.path.join(VECTOR_STORE_PATH, name)
+        existed = os.path.exists(os.path.join(path, "meta.json"))
+        if drop and existed:
+            for file_name in os.listdir(path):
+                os.remove(os.path.join(path, file_name))
+        return LocalStore(path, metric, LOCAL_INDEX, id_field, text_field, schema.auto_id, np.float16 if VECTOR_TYPE == "float16" else np.float32, projection), existed
+
+    if VECTOR_STORE != "milvus":
+        raise ValueError(f"Unknown vector store: {VECTOR_STORE}, expected milvus or local")
+    from pymilvus import Collection, utility
+    connect_milvus(milvus_uri)
+    existed = utility.has_collection(name)
+    if drop and existed:
+        utility.drop_collection(name)
+        print(f"Collection '{name}' dropped.")
+    return MilvusStore(Collection(name, schema), id_field, text_field, metric, projection=projection, consistency_level=consistency_level), existed